@@ -0,0 +1,21 @@
+import importlib
+
+
+class LazyModule:
+    "Stands in for module `name`, importing it on first attribute access."
+
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr: str):
+        return getattr(self._load(), attr)
+
+    def __repr__(self) -> str:
+        state = 'loaded' if self._module is not None else 'not loaded'
+        return '<lazy module {0!r} ({1})>'.format(self._name, state)
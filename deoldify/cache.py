@@ -0,0 +1,180 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from dataclasses import dataclass
+from io import BytesIO
+from pathlib import Path
+
+from PIL import Image
+
+
+def result_cache_key(
+    image_hash: str, render_factor: int, weights_name: str, post_process: bool, watermarked: bool
+) -> str:
+    "Key for a colorized result: everything that can change the output pixels for a given source image."
+    key = {
+        'image': image_hash,
+        'render_factor': render_factor,
+        'weights_name': weights_name,
+        'post_process': post_process,
+        'watermarked': watermarked,
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+class ResultCache(ABC):
+    "Base class for colorized result stores; subclasses implement `_get`, `_put` and `__len__`."
+
+    def __init__(self):
+        self.stats = CacheStats()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Image.Image:
+        "The cached image for `key` (a copy the caller may close or modify), or None."
+        with self._lock:
+            image = self._get(key)
+            if image is None:
+                self.stats.misses += 1
+            else:
+                self.stats.hits += 1
+            return image
+
+    def put(self, key: str, image: Image.Image):
+        with self._lock:
+            self._put(key, image)
+
+    @abstractmethod
+    def _get(self, key: str) -> Image.Image:
+        pass
+
+    @abstractmethod
+    def _put(self, key: str, image: Image.Image):
+        pass
+
+    @abstractmethod
+    def __len__(self) -> int:
+        pass
+
+
+class MemoryResultCache(ResultCache):
+    "In-process LRU holding decoded images, bounded by their total pixel buffer size."
+
+    def __init__(self, max_bytes: int = 512 * 1024 * 1024):
+        super().__init__()
+        self.max_bytes = max_bytes
+        self.size_bytes = 0
+        self._entries = OrderedDict()
+
+    @staticmethod
+    def _nbytes(image: Image.Image) -> int:
+        return image.width * image.height * len(image.getbands())
+
+    def _get(self, key: str) -> Image.Image:
+        image = self._entries.get(key)
+        if image is None:
+            return None
+        self._entries.move_to_end(key)
+        return image.copy()
+
+    def _put(self, key: str, image: Image.Image):
+        nbytes = self._nbytes(image)
+        if nbytes > self.max_bytes:
+            return
+        if key in self._entries:
+            self.size_bytes -= self._nbytes(self._entries.pop(key))
+        self._entries[key] = image.copy()
+        self.size_bytes += nbytes
+        while self.size_bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.size_bytes -= self._nbytes(evicted)
+            self.stats.evictions += 1
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class DiskResultCache(ResultCache):
+    """Results stored as PNG files under `root`, evicting the least recently used files once
+    their total size exceeds `max_bytes`.  Survives restarts and can be shared by processes,
+    though each process only accounts for the files it has seen."""
+
+    def __init__(self, root: Path, max_bytes: int = 2 * 1024 * 1024 * 1024):
+        super().__init__()
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self._sizes = {}
+        for path in self.root.glob('*.png'):
+            self._sizes[path.stem] = path.stat().st_size
+        self.size_bytes = sum(self._sizes.values())
+
+    def _path(self, key: str) -> Path:
+        return self.root / (key + '.png')
+
+    def _get(self, key: str) -> Image.Image:
+        path = self._path(key)
+        try:
+            with open(str(path), 'rb') as f:
+                data = f.read()
+            # Bump the modification time so eviction order follows use, not creation.
+            os.utime(str(path))
+        except OSError:
+            self._sizes.pop(key, None)
+            return None
+        image = Image.open(BytesIO(data))
+        image.load()
+        return image
+
+    def _put(self, key: str, image: Image.Image):
+        buffer = BytesIO()
+        image.save(buffer, format='PNG')
+        data = buffer.getvalue()
+        if len(data) > self.max_bytes:
+            return
+        path = self._path(key)
+        tmp_path = path.with_suffix('.tmp')
+        with open(str(tmp_path), 'wb') as f:
+            f.write(data)
+        os.replace(str(tmp_path), str(path))
+        self.size_bytes += len(data) - self._sizes.get(key, 0)
+        self._sizes[key] = len(data)
+        if self.size_bytes > self.max_bytes:
+            self._evict(keep=key)
+
+    def _evict(self, keep: str):
+        def mtime(key):
+            try:
+                return self._path(key).stat().st_mtime
+            except OSError:
+                return 0.0
+
+        for key in sorted(self._sizes, key=mtime):
+            if self.size_bytes <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            try:
+                os.remove(str(self._path(key)))
+            except OSError as e:
+                logging.warning('Could not evict cached result ' + key + ': ' + str(e))
+            self.size_bytes -= self._sizes.pop(key)
+            self.stats.evictions += 1
+
+    def __len__(self) -> int:
+        return len(self._sizes)
@@ -1,7 +1,10 @@
 from fastai import *
 from fastai.core import *
+from fastai.torch_core import *
 from fastai.vision.transform import get_transforms
-from fastai.vision.data import ImageImageList, ImageDataBunch, imagenet_stats
+from fastai.basic_data import DataBunch
+from fastai.vision.data import ImageImageList, ImageDataBunch, imagenet_stats, normalize_funcs
+from fastai.vision.image import Image
 
 
 def get_colorize_data(
@@ -44,3 +47,25 @@ def get_dummy_databunch() -> ImageDataBunch:
     return get_colorize_data(
         sz=1, bs=1, crappy_path=path, good_path=path, keep_pct=0.001
     )
+
+
+class _InferenceDataset(Dataset):
+    "Empty dataset that only knows how to turn generator output back into an `Image`, like `ImageImageList`."
+
+    def __len__(self):
+        return 0
+
+    def __getitem__(self, i):
+        raise IndexError(i)
+
+    def reconstruct(self, t: Tensor) -> Image:
+        return Image(t.float().clamp(min=0, max=1))
+
+
+def get_inference_databunch(stats: tuple = imagenet_stats) -> DataBunch:
+    "Stand-in for `get_dummy_databunch` that needs no folder on disk, no transforms and no data."
+    ds = _InferenceDataset()
+    data = DataBunch(DataLoader(ds, batch_size=1), DataLoader(ds, batch_size=1), no_check=True)
+    data.norm, data.denorm = normalize_funcs(*stats, do_x=True, do_y=True)
+    data.c = 3
+    return data
@@ -9,8 +9,12 @@ from fastai import *
 import cv2
 from PIL import Image as PilImage
 from deoldify import device as device_settings
+from .instrument import stage
 import logging
 
+# `torch.inference_mode` only exists from torch 1.9 on.
+_inference_mode = getattr(torch, 'inference_mode', torch.no_grad)
+
 
 class IFilter(ABC):
     @abstractmethod
@@ -19,15 +23,40 @@ class IFilter(ABC):
     ) -> PilImage:
         pass
 
+    def filter_batch(
+        self, orig_images: List[PilImage], filtered_images: List[PilImage], render_factor: int, post_process: bool = True
+    ) -> List[PilImage]:
+        return [
+            self.filter(orig_image, filtered_image, render_factor, post_process)
+            for orig_image, filtered_image in zip(orig_images, filtered_images)
+        ]
+
+    def filter_arrays(
+        self, orig_arrays: List[np.ndarray], filtered_arrays: List[np.ndarray], render_factor: int, post_process: bool = True
+    ) -> List[np.ndarray]:
+        results = self.filter_batch(
+            [PilImage.fromarray(a) for a in orig_arrays],
+            [PilImage.fromarray(a) for a in filtered_arrays],
+            render_factor,
+            post_process,
+        )
+        return [np.asarray(result) for result in results]
+
 
 class BaseFilter(IFilter):
-    def __init__(self, learn: Learner, stats: tuple = imagenet_stats):
+    def __init__(self, learn: Learner, stats: tuple = imagenet_stats, lean_inference: bool = False):
         super().__init__()
         self.learn = learn
+        self.lean_inference = lean_inference
+        self.channels_last = False
         
         if not device_settings.is_gpu():
             self.learn.model = self.learn.model.cpu()
         
+        if lean_inference:
+            # Put the model in eval mode once up front rather than flipping it on every call.
+            self.learn.model.eval()
+
         self.device = next(self.learn.model.parameters()).device
         self.norm, self.denorm = normalize_funcs(*stats)
 
@@ -46,26 +75,58 @@ class BaseFilter(IFilter):
         return result
 
     def _model_process(self, orig: PilImage, sz: int) -> PilImage:
-        model_image = self._get_model_ready_image(orig, sz)
-        x = pil2tensor(model_image, np.float32)
-        x = x.to(self.device)
-        x.div_(255)
-        x, y = self.norm((x, x), do_x=True)
-        
+        return self._model_process_batch([orig], sz)[0]
+
+    def _model_process_batch(self, origs: List[PilImage], sz: int) -> List[PilImage]:
+        # All images share the same square render size, so they can be stacked
+        # into a single batch and run through the generator in one forward pass.
+        with stage('scale_to_square'):
+            model_images = [self._get_model_ready_image(orig, sz) for orig in origs]
+        with stage('to_tensor'):
+            x, y = self._prepare_batch(model_images)
+
         try:
-            result = self.learn.pred_batch(
-                ds_type=DatasetType.Valid, batch=(x[None], y[None]), reconstruct=True
-            )
+            outs = self._predict(x, y)
         except RuntimeError as rerr:
             if 'memory' not in str(rerr):
                 raise rerr
             logging.warn('Warning: render_factor was set too high, and out of memory error resulted. Returning original image.')
-            return model_image
-            
-        out = result[0]
-        out = self.denorm(out.px, do_x=False)
-        out = image2np(out * 255).astype(np.uint8)
-        return PilImage.fromarray(out)
+            return model_images
+
+        return [PilImage.fromarray(out) for out in outs]
+
+    def _prepare_batch(self, model_images: List[PilImage]) -> Tuple[Tensor, Tensor]:
+        x = torch.stack([pil2tensor(image, np.float32) for image in model_images])
+        x = x.to(self.device)
+        x.div_(255)
+        return self.norm((x, x), do_x=True)
+
+    def _predict(self, x: Tensor, y: Tensor) -> np.ndarray:
+        "Run the normalized batch `x` through the generator, returning a uint8 NHWC array."
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+        if self.lean_inference:
+            return self._predict_lean(x)
+
+        with stage('forward'):
+            result = self.learn.pred_batch(
+                ds_type=DatasetType.Valid, batch=(x, y), reconstruct=True
+            )
+        with stage('denorm'):
+            outs = []
+            for out in result:
+                out = self.denorm(out.px, do_x=False)
+                outs.append(image2np(out * 255).astype(np.uint8))
+            return np.stack(outs)
+
+    def _predict_lean(self, x: Tensor) -> np.ndarray:
+        # Same math as `Learner.pred_batch(reconstruct=True)` (denormalize, clamp to [0,1], scale),
+        # minus the callback handler, train/eval toggling and fastai `Image` wrapping.
+        with stage('forward'), _inference_mode():
+            out = self.learn.model(x)
+        with stage('denorm'):
+            out = self.denorm(out, do_x=True).clamp_(0, 1).mul_(255)
+            return out.permute(0, 2, 3, 1).to(torch.uint8).numpy()
 
     def _unsquare(self, image: PilImage, orig: PilImage) -> PilImage:
         targ_sz = orig.size
@@ -74,21 +135,167 @@ class BaseFilter(IFilter):
 
 
 class ColorizerFilter(BaseFilter):
-    def __init__(self, learn: Learner, stats: tuple = imagenet_stats):
-        super().__init__(learn=learn, stats=stats)
+    def __init__(
+        self,
+        learn: Learner,
+        stats: tuple = imagenet_stats,
+        lean_inference: bool = False,
+        tile_size: int = None,
+        tile_overlap: int = 64,
+        tile_batch_size: int = 4,
+    ):
+        super().__init__(learn=learn, stats=stats, lean_inference=lean_inference)
         self.render_base = 16
+        # Images larger than `tile_size` (in source pixels) are colorized tile by tile; see `_filter_tiled`.
+        self.tile_size = tile_size
+        self.tile_overlap = tile_overlap
+        self.tile_batch_size = tile_batch_size
+
+    def _is_tiled(self, image: PilImage) -> bool:
+        return self.tile_size is not None and max(image.size) > self.tile_size
 
     def filter(
         self, orig_image: PilImage, filtered_image: PilImage, render_factor: int, post_process: bool = True) -> PilImage:
+        if self._is_tiled(orig_image):
+            return self._filter_tiled(orig_image, filtered_image, render_factor, post_process)
+
         render_sz = render_factor * self.render_base
         model_image = self._model_process(orig=filtered_image, sz=render_sz)
-        raw_color = self._unsquare(model_image, orig_image)
+        with stage('unsquare'):
+            raw_color = self._unsquare(model_image, orig_image)
 
         if post_process:
-            return self._post_process(raw_color, orig_image)
+            with stage('post_process'):
+                return self._post_process(raw_color, orig_image)
         else:
             return raw_color
 
+    def filter_batch(
+        self, orig_images: List[PilImage], filtered_images: List[PilImage], render_factor: int, post_process: bool = True) -> List[PilImage]:
+        if any(self._is_tiled(image) for image in orig_images):
+            # Tiled images batch their own tiles, so go one image at a time.
+            return super().filter_batch(orig_images, filtered_images, render_factor, post_process)
+
+        render_sz = render_factor * self.render_base
+        model_images = self._model_process_batch(origs=filtered_images, sz=render_sz)
+        results = []
+        for model_image, orig_image in zip(model_images, orig_images):
+            with stage('unsquare'):
+                raw_color = self._unsquare(model_image, orig_image)
+            if post_process:
+                with stage('post_process'):
+                    raw_color = self._post_process(raw_color, orig_image)
+            results.append(raw_color)
+        return results
+
+    def filter_arrays(
+        self, orig_arrays: List[np.ndarray], filtered_arrays: List[np.ndarray], render_factor: int, post_process: bool = True
+    ) -> List[np.ndarray]:
+        # Array-native equivalent of `filter_batch`: RGB uint8 HxWx3 arrays in and out, no PIL round trips.
+        if self.tile_size is not None and any(max(a.shape[:2]) > self.tile_size for a in orig_arrays):
+            return super().filter_arrays(orig_arrays, filtered_arrays, render_factor, post_process)
+
+        render_sz = render_factor * self.render_base
+        model_arrays = self._model_process_arrays(filtered_arrays, render_sz)
+        # The chroma-only resample does unsquaring and post processing in one step.
+        with stage('unsquare'):
+            return [
+                self._unsquare_array(model_array, orig_array, post_process)
+                for model_array, orig_array in zip(model_arrays, orig_arrays)
+            ]
+
+    def _tile_origins(self, length: int, tile: int) -> List[int]:
+        stride = max(1, tile - self.tile_overlap)
+        origins = list(range(0, max(1, length - tile), stride))
+        if origins[-1] + tile < length:
+            origins.append(length - tile)
+        return origins
+
+    def _tile_weights(self, h: int, w: int) -> np.ndarray:
+        # Feathered weights: ramp up linearly across the overlap from each edge, flat in the middle.
+        def ramp(n: int) -> np.ndarray:
+            dist = np.minimum(np.arange(n) + 1, n - np.arange(n)).astype(np.float32)
+            return np.minimum(1.0, dist / max(1, self.tile_overlap))
+
+        return np.outer(ramp(h), ramp(w))
+
+    def _filter_tiled(
+        self, orig_image: PilImage, filtered_image: PilImage, render_factor: int, post_process: bool = True) -> PilImage:
+        render_sz = render_factor * self.render_base
+        w, h = orig_image.size
+        tw, th = min(self.tile_size, w), min(self.tile_size, h)
+
+        # One low-res pass over the whole image gives every tile the same global color context.
+        global_color = self._unsquare(self._model_process(orig=filtered_image, sz=render_sz), orig_image)
+        global_uv = cv2.cvtColor(np.asarray(global_color), cv2.COLOR_RGB2YUV)[:, :, 1:3].astype(np.float32)
+
+        boxes = [
+            (x, y, x + tw, y + th)
+            for y in self._tile_origins(h, th)
+            for x in self._tile_origins(w, tw)
+        ]
+        weights = self._tile_weights(th, tw)
+        acc = np.zeros((h, w, 3), dtype=np.float32)
+        acc_weight = np.zeros((h, w), dtype=np.float32)
+
+        for i in range(0, len(boxes), self.tile_batch_size):
+            batch = boxes[i : i + self.tile_batch_size]
+            tiles = [filtered_image.crop(box) for box in batch]
+            model_images = self._model_process_batch(origs=tiles, sz=render_sz)
+            for (x0, y0, x1, y1), tile, model_image in zip(batch, tiles, model_images):
+                yuv = cv2.cvtColor(np.asarray(self._unsquare(model_image, tile)), cv2.COLOR_RGB2YUV)
+                yuv = yuv.astype(np.float32)
+                # Anchor each tile's average chroma to the global pass so tiles agree on overall color.
+                context = global_uv[y0:y1, x0:x1].mean(axis=(0, 1))
+                yuv[:, :, 1:3] += context - yuv[:, :, 1:3].mean(axis=(0, 1))
+                acc[y0:y1, x0:x1] += yuv * weights[:, :, None]
+                acc_weight[y0:y1, x0:x1] += weights
+
+        yuv = acc / acc_weight[:, :, None]
+        if post_process:
+            yuv[:, :, 0] = cv2.cvtColor(np.asarray(orig_image), cv2.COLOR_RGB2YUV)[:, :, 0]
+        yuv = np.clip(yuv, 0, 255).astype(np.uint8)
+        return PilImage.fromarray(cv2.cvtColor(yuv, cv2.COLOR_YUV2RGB))
+
+    def _scale_array_to_square(self, gray: np.ndarray, targ: int) -> np.ndarray:
+        # INTER_AREA when shrinking stands in for the antialiasing PIL applies in its bilinear resize.
+        h, w = gray.shape[:2]
+        interpolation = cv2.INTER_AREA if targ < min(h, w) else cv2.INTER_LINEAR
+        return cv2.resize(gray, (targ, targ), interpolation=interpolation)
+
+    def _model_process_arrays(self, origs: List[np.ndarray], sz: int) -> np.ndarray:
+        # Going to grayscale before resizing means only one channel is resampled and uploaded;
+        # the three identical model input channels are a broadcast view until normalization.
+        with stage('scale_to_square'):
+            grays = np.stack(
+                [self._scale_array_to_square(cv2.cvtColor(orig, cv2.COLOR_RGB2GRAY), sz) for orig in origs]
+            )
+        with stage('to_tensor'):
+            x = torch.from_numpy(grays).to(self.device)[:, None].float().div_(255)
+            x = x.expand(-1, 3, -1, -1)
+            x, y = self.norm((x, x), do_x=True)
+
+        try:
+            return self._predict(x, y)
+        except RuntimeError as rerr:
+            if 'memory' not in str(rerr):
+                raise rerr
+            logging.warn('Warning: render_factor was set too high, and out of memory error resulted. Returning original image.')
+            return np.repeat(grays[..., None], 3, axis=3)
+
+    def _unsquare_array(self, color: np.ndarray, orig: np.ndarray, post_process: bool) -> np.ndarray:
+        h, w = orig.shape[:2]
+        if not post_process:
+            return cv2.resize(color, (w, h), interpolation=cv2.INTER_LINEAR)
+
+        # Same result as `_unsquare` + `_post_process`, but only the two chroma channels are resampled
+        # to full resolution and the original's YUV array is reused as the output buffer.
+        chroma = np.ascontiguousarray(cv2.cvtColor(color, cv2.COLOR_RGB2YUV)[:, :, 1:3])
+        chroma = cv2.resize(chroma, (w, h), interpolation=cv2.INTER_LINEAR)
+        hires = cv2.cvtColor(orig, cv2.COLOR_RGB2YUV)
+        hires[:, :, 1:3] = chroma
+        return cv2.cvtColor(hires, cv2.COLOR_YUV2RGB, dst=hires)
+
     def _transform(self, image: PilImage) -> PilImage:
         return image.convert('LA').convert('RGB')
 
@@ -110,6 +317,145 @@ class ColorizerFilter(BaseFilter):
         return final
 
 
+class ChromaReuseFilter(IFilter):
+    "Wraps a `ColorizerFilter`, reusing the last rendered chroma for near-duplicate frames."
+
+    def __init__(self, colorizer: ColorizerFilter, threshold: float = 2.0, thumb_size: int = 64):
+        super().__init__()
+        self.colorizer = colorizer
+        self.threshold = threshold
+        self.thumb_size = thumb_size
+        self.reset()
+
+    def reset(self):
+        self.frames = 0
+        self.skipped = 0
+        self._last_key = None
+        self._last_features = None
+        self._last_raw_color = None
+
+    @property
+    def skip_ratio(self) -> float:
+        return self.skipped / self.frames if self.frames > 0 else 0.0
+
+    def _features(self, image: PilImage) -> np.ndarray:
+        thumb_sz = (self.thumb_size, self.thumb_size)
+        return np.asarray(image.convert('L').resize(thumb_sz, resample=PIL.Image.BILINEAR), dtype=np.float32)
+
+    def _reuse_chroma(self, features: np.ndarray, orig_image: PilImage) -> Optional[PilImage]:
+        # Compare against the last frame that actually went through the model, not just the previous
+        # frame, so slow drift across a run of "duplicates" still forces a fresh render.
+        if np.abs(features - self._last_features).mean() <= self.threshold:
+            return self._last_raw_color
+        return None
+
+    def _remember(self, features: np.ndarray, raw_color: PilImage):
+        self._last_features = features
+        self._last_raw_color = raw_color
+
+    def filter(
+        self, orig_image: PilImage, filtered_image: PilImage, render_factor: int, post_process: bool = True) -> PilImage:
+        self.frames += 1
+        key = (render_factor, orig_image.size)
+        features = self._features(filtered_image)
+        raw_color = None
+        if self._last_features is not None and key == self._last_key:
+            raw_color = self._reuse_chroma(features, orig_image)
+
+        if raw_color is not None:
+            self.skipped += 1
+        else:
+            raw_color = self.colorizer.filter(orig_image, filtered_image, render_factor, post_process=False)
+            self._last_key = key
+            self._remember(features, raw_color)
+
+        if post_process:
+            return self.colorizer._post_process(raw_color, orig_image)
+        else:
+            return raw_color
+
+
+class FlowPropagationFilter(ChromaReuseFilter):
+    """Wraps a `ColorizerFilter`, rendering only keyframes and carrying their chroma to the frames in
+    between with dense optical flow.  A keyframe is rendered every `keyframe_interval` frames, or sooner
+    when the flow-warped keyframe no longer matches the current frame (scene cuts, fast motion).
+
+    Frames must be passed in playback order: the interval counts calls, and the flow is computed from
+    the keyframe to whichever frame comes next.  `reset` between videos."""
+
+    def __init__(
+        self, colorizer: ColorizerFilter, keyframe_interval: int = 8, drift_threshold: float = 6.0, flow_width: int = 480
+    ):
+        self.keyframe_interval = keyframe_interval
+        self.flow_width = flow_width
+        self._grids = {}
+        super().__init__(colorizer, threshold=drift_threshold)
+
+    def reset(self):
+        super().reset()
+        self._since_keyframe = 0
+
+    def _grid(self, w: int, h: int) -> Tuple[np.ndarray, np.ndarray]:
+        if (w, h) not in self._grids:
+            self._grids[(w, h)] = np.meshgrid(np.arange(w, dtype=np.float32), np.arange(h, dtype=np.float32))
+        return self._grids[(w, h)]
+
+    def _features(self, image: PilImage) -> np.ndarray:
+        w, h = image.size
+        flow_sz = (min(w, self.flow_width), max(1, round(h * min(w, self.flow_width) / w)))
+        return np.asarray(image.convert('L').resize(flow_sz, resample=PIL.Image.BILINEAR))
+
+    def _reuse_chroma(self, features: np.ndarray, orig_image: PilImage) -> Optional[PilImage]:
+        if self._since_keyframe + 1 >= self.keyframe_interval:
+            return None
+
+        # Backward flow: for every pixel of the current frame, where it came from in the keyframe.
+        flow = cv2.calcOpticalFlowFarneback(features, self._last_features, None, 0.5, 3, 15, 3, 5, 1.2, 0)
+        h, w = features.shape
+        grid_x, grid_y = self._grid(w, h)
+        warped = cv2.remap(
+            self._last_features, grid_x + flow[..., 0], grid_y + flow[..., 1],
+            cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE,
+        )
+        drift = np.abs(warped.astype(np.float32) - features.astype(np.float32)).mean()
+        if drift > self.threshold:
+            return None
+
+        full_w, full_h = orig_image.size
+        full_x, full_y = self._grid(full_w, full_h)
+        flow = cv2.resize(flow, (full_w, full_h), interpolation=cv2.INTER_LINEAR)
+        map_x = full_x + flow[..., 0] * (full_w / w)
+        map_y = full_y + flow[..., 1] * (full_h / h)
+        color = cv2.remap(
+            np.asarray(self._last_raw_color), map_x, map_y, cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE
+        )
+        self._since_keyframe += 1
+        return PilImage.fromarray(color)
+
+    def _remember(self, features: np.ndarray, raw_color: PilImage):
+        super()._remember(features, raw_color)
+        self._since_keyframe = 0
+
+
+def check_color_deviation(
+    reference: IFilter, candidate: IFilter, images: List[PilImage], render_factor: int
+) -> dict:
+    "Compare the chroma `candidate` produces on `images` against `reference`, in 0-255 YUV units."
+    deviations = []
+    for image in images:
+        expected = reference.filter(image, image, render_factor, post_process=True)
+        actual = candidate.filter(image, image, render_factor, post_process=True)
+        expected_uv = cv2.cvtColor(np.asarray(expected), cv2.COLOR_RGB2YUV)[:, :, 1:3].astype(np.float32)
+        actual_uv = cv2.cvtColor(np.asarray(actual), cv2.COLOR_RGB2YUV)[:, :, 1:3].astype(np.float32)
+        deviations.append(np.abs(expected_uv - actual_uv))
+
+    return {
+        'images': len(images),
+        'mean_chroma_deviation': float(np.mean([d.mean() for d in deviations])) if deviations else 0.0,
+        'max_chroma_deviation': float(max(d.max() for d in deviations)) if deviations else 0.0,
+    }
+
+
 class MasterFilter(BaseFilter):
     def __init__(self, filters: List[IFilter], render_factor: int):
         self.filters = filters
@@ -118,7 +464,26 @@ class MasterFilter(BaseFilter):
     def filter(
         self, orig_image: PilImage, filtered_image: PilImage, render_factor: int = None, post_process: bool = True) -> PilImage:
         render_factor = self.render_factor if render_factor is None else render_factor
-        for filter in self.filters:
-            filtered_image = filter.filter(orig_image, filtered_image, render_factor, post_process)
+        with stage('filter'):
+            for filter in self.filters:
+                filtered_image = filter.filter(orig_image, filtered_image, render_factor, post_process)
 
         return filtered_image
+
+    def filter_batch(
+        self, orig_images: List[PilImage], filtered_images: List[PilImage], render_factor: int = None, post_process: bool = True) -> List[PilImage]:
+        render_factor = self.render_factor if render_factor is None else render_factor
+        with stage('filter'):
+            for filter in self.filters:
+                filtered_images = filter.filter_batch(orig_images, filtered_images, render_factor, post_process)
+
+        return filtered_images
+
+    def filter_arrays(
+        self, orig_arrays: List[np.ndarray], filtered_arrays: List[np.ndarray], render_factor: int = None, post_process: bool = True) -> List[np.ndarray]:
+        render_factor = self.render_factor if render_factor is None else render_factor
+        with stage('filter'):
+            for filter in self.filters:
+                filtered_arrays = filter.filter_arrays(orig_arrays, filtered_arrays, render_factor, post_process)
+
+        return filtered_arrays
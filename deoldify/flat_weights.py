@@ -0,0 +1,178 @@
+"""A flat, memory-mappable weight format for inference.
+
+A `.flat` file is an 8 byte magic, an 8 byte little-endian header length, a JSON header mapping
+each state dict key to its dtype, shape and byte offset, and then the raw tensor data, each tensor
+aligned to 64 bytes.  `load_flat_weights` maps the file read-only and returns tensors that point
+straight into the mapping, so every process loading the same file shares one page-cache copy of
+the weights instead of each holding its own unpickled one.
+
+Convert existing checkpoints with `python -m deoldify.flat_weights models/*.pth`.
+"""
+import argparse
+import json
+import os
+import struct
+import warnings
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict
+
+from fastai.basic_train import Learner
+from fastai.torch_core import *
+
+
+_MAGIC = b'DEOLDFLT'
+_ALIGN = 64
+_dtypes = {
+    'float32': torch.float32,
+    'float16': torch.float16,
+    'float64': torch.float64,
+    'int64': torch.int64,
+    'int32': torch.int32,
+    'int16': torch.int16,
+    'int8': torch.int8,
+    'uint8': torch.uint8,
+    'bool': torch.bool,
+}
+
+
+def _aligned(offset: int) -> int:
+    return (offset + _ALIGN - 1) // _ALIGN * _ALIGN
+
+
+def save_flat_weights(state_dict: Dict[str, Tensor], path: Path) -> Path:
+    "Write `state_dict` to `path` in the flat format."
+    path = Path(path)
+    arrays = OrderedDict()
+    for name, tensor in state_dict.items():
+        dtype = str(tensor.dtype).replace('torch.', '')
+        if dtype not in _dtypes:
+            raise ValueError('Unsupported dtype {0} for {1} in flat weights.'.format(tensor.dtype, name))
+        arrays[name] = tensor.detach().cpu().contiguous().numpy()
+
+    # Offsets depend on the header's length and the header holds the offsets, so size it with
+    # placeholder offsets of the final width first.
+    def header_for(data_start: int) -> bytes:
+        entries, offset = {}, data_start
+        for name, array in arrays.items():
+            entries[name] = {'dtype': str(array.dtype), 'shape': list(array.shape), 'offset': offset, 'nbytes': array.nbytes}
+            offset = _aligned(offset + array.nbytes)
+        return json.dumps(entries).encode('utf-8')
+
+    data_start = _aligned(16 + len(header_for(1 << 62)))
+    header = header_for(data_start)
+    header += b' ' * (data_start - 16 - len(header))
+
+    tmp_path = path.with_suffix('.tmp')
+    with open(str(tmp_path), 'wb') as f:
+        f.write(_MAGIC + struct.pack('<Q', len(header)) + header)
+        for array in arrays.values():
+            f.write(array.tobytes())
+            f.write(b'\0' * (_aligned(f.tell()) - f.tell()))
+    os.replace(str(tmp_path), str(path))
+    return path
+
+
+def load_flat_weights(path: Path) -> Dict[str, Tensor]:
+    "Map the flat weights at `path` read-only; the returned tensors must not be modified in place."
+    mapped = np.memmap(str(path), dtype=np.uint8, mode='r')
+    if bytes(mapped[:8]) != _MAGIC:
+        raise ValueError(str(path) + ' is not a flat weights file.')
+    (header_len,) = struct.unpack('<Q', bytes(mapped[8:16]))
+    header = json.loads(bytes(mapped[16 : 16 + header_len]).decode('utf-8'))
+    state = OrderedDict()
+    with warnings.catch_warnings():
+        # torch warns about wrapping read-only arrays; read-only is the point here.
+        warnings.simplefilter('ignore', UserWarning)
+        for name, entry in header.items():
+            shape = tuple(entry['shape'])
+            if entry['nbytes'] == 0:
+                state[name] = torch.empty(shape, dtype=_dtypes[entry['dtype']])
+                continue
+            start = entry['offset']
+            array = mapped[start : start + entry['nbytes']].view(np.dtype(entry['dtype'])).reshape(shape)
+            state[name] = torch.from_numpy(array)
+    return state
+
+
+def assign_flat_weights(model: nn.Module, state: Dict[str, Tensor], strict: bool = True) -> nn.Module:
+    """Make the parameters and buffers of `model` *be* the tensors in `state`, instead of copying
+    into them like `load_state_dict` does, so mapped weights stay shared.  For inference only."""
+    own = dict(model.named_parameters())
+    own.update(dict(model.named_buffers()))
+    if strict:
+        missing, unexpected = set(own) - set(state), set(state) - set(own)
+        if missing or unexpected:
+            raise KeyError(
+                'Flat weights do not match the model. Missing: {0}. Unexpected: {1}.'.format(
+                    sorted(missing), sorted(unexpected)
+                )
+            )
+    for name, tensor in state.items():
+        if name not in own:
+            continue
+        if own[name].shape != tensor.shape:
+            raise ValueError('Shape mismatch for {0}: {1} vs {2}.'.format(name, tuple(own[name].shape), tuple(tensor.shape)))
+        module_name, _, attr = name.rpartition('.')
+        module = model.get_submodule(module_name) if module_name else model
+        if attr in module._parameters:
+            module._parameters[attr] = nn.Parameter(tensor, requires_grad=False)
+        else:
+            module._buffers[attr] = tensor
+    return model
+
+
+def load_learner_flat(learn: Learner, name: str, strict: bool = True) -> Learner:
+    "Like `learn.load(name)`, but from `model_dir/name.flat`, memory mapped and shared between processes."
+    path = learn.path / learn.model_dir / (name + '.flat')
+    if not path.exists():
+        raise FileNotFoundError(
+            str(path) + ' not found; create it with `python -m deoldify.flat_weights ' + str(path.with_suffix('.pth')) + '`.'
+        )
+    model = get_model(learn.model)
+    assign_flat_weights(model, load_flat_weights(path), strict=strict)
+    device = learn.data.device
+    if device.type != 'cpu':
+        # Moving to the GPU copies the weights anyway; the mapping only saves host memory.
+        model.to(device)
+    return learn
+
+
+def convert_checkpoint(pth_path: Path, artistic: bool = None, flat_path: Path = None) -> Path:
+    """Convert a `Learner.save` checkpoint at `models/<name>.pth` to the flat format.
+
+    The generator is built and loaded through `Learner.load`, which drops any optimizer state and
+    runs the modules' state dict hooks (spectral norm's among them), and its own `state_dict()` is
+    what gets written, so the result always matches what `load_learner_flat` assigns into.
+    `artistic` picks the deep (artistic) or wide (stable, video) generator; by default it's guessed
+    from the file name.
+    """
+    # Imported here since `generators` imports this module.
+    from .generators import gen_inference_deep, gen_inference_wide
+
+    pth_path = Path(pth_path)
+    artistic = ifnone(artistic, 'artistic' in pth_path.stem.lower())
+    gen_inference = gen_inference_deep if artistic else gen_inference_wide
+    # Weights are read from <root_folder>/models/<weights_name>.pth.
+    learn = gen_inference(root_folder=pth_path.parent.parent, weights_name=pth_path.stem, fast=True)
+    state = get_model(learn.model).state_dict()
+    return save_flat_weights(state, ifnone(flat_path, pth_path.with_suffix('.flat')))
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Convert models/*.pth checkpoints to memory-mappable .flat weights.')
+    parser.add_argument('checkpoints', nargs='+', type=Path)
+    parser.add_argument(
+        '--arch', choices=['auto', 'deep', 'wide'], default='auto',
+        help='Generator to load the checkpoints into: deep (artistic) or wide (stable, video).  '
+        'By default guessed from the file name.',
+    )
+    args = parser.parse_args(args)
+    artistic = {'auto': None, 'deep': True, 'wide': False}[args.arch]
+    for pth_path in args.checkpoints:
+        flat_path = convert_checkpoint(pth_path, artistic=artistic)
+        print('{0} -> {1}'.format(pth_path, flat_path))
+
+
+if __name__ == '__main__':
+    main()
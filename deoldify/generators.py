@@ -5,28 +5,85 @@ from fastai.torch_core import SplitFuncOrIdxList, apply_init, to_device
 from fastai.vision import *
 from fastai.vision.learner import cnn_config, create_body
 from torch import nn
-from .unet import DynamicUnetWide, DynamicUnetDeep
+from .unet import DynamicUnetWide, DynamicUnetDeep, ExplicitSkipUnet
 from .dataset import *
+from .optimize import optimize_for_inference
+from .flat_weights import load_learner_flat
+from .layers import use_chunked_attention
+
+def _resnet_sizes(expansion: int) -> Sizes:
+    # conv1, bn1, relu, maxpool, layer1..layer4 at the 256x256 size the U-Nets are built with
+    shapes = [(64, 128), (64, 128), (64, 128), (64, 64), (64 * expansion, 64),
+              (128 * expansion, 32), (256 * expansion, 16), (512 * expansion, 8)]
+    return [torch.Size([1, c, sz, sz]) for c, sz in shapes]
+
+
+_encoder_sizes = {
+    'resnet18': _resnet_sizes(1),
+    'resnet34': _resnet_sizes(1),
+    'resnet50': _resnet_sizes(4),
+    'resnet101': _resnet_sizes(4),
+    'resnet152': _resnet_sizes(4),
+}
+
+
+def get_encoder_sizes(arch: Callable) -> Optional[Sizes]:
+    "Precomputed encoder activation sizes for `arch`, or `None` if they have to be measured."
+    return _encoder_sizes.get(getattr(arch, '__name__', None))
+
 
 # Weights are implicitly read from ./models/ folder
 def gen_inference_wide(
-    root_folder: Path, weights_name: str, nf_factor: int = 2, arch=models.resnet101) -> Learner:
-    data = get_dummy_databunch()
+    root_folder: Path, weights_name: str, nf_factor: int = 2, arch=models.resnet101, optimize: bool = False,
+    attention_chunk_size: int = None, fast: bool = False, mmap_weights: bool = False) -> Learner:
+    # `fast` skips the ImageNet weights download, the dummy DataBunch, the encoder's dummy forward
+    # pass and the Learner purge on load; all of them are redundant once the weights are loaded.
+    # `mmap_weights` maps `models/<weights_name>.flat` read-only instead of unpickling the .pth.
+    data = get_inference_databunch() if fast else get_dummy_databunch()
     learn = gen_learner_wide(
-        data=data, gen_loss=F.l1_loss, nf_factor=nf_factor, arch=arch
+        data=data,
+        gen_loss=F.l1_loss,
+        nf_factor=nf_factor,
+        arch=arch,
+        pretrained=not fast,
+        encoder_sizes=get_encoder_sizes(arch) if fast else None,
     )
     learn.path = root_folder
-    learn.load(weights_name)
+    if mmap_weights:
+        load_learner_flat(learn, weights_name)
+    else:
+        learn.load(weights_name, purge=not fast)
     learn.model.eval()
+    if optimize:
+        optimize_for_inference(learn.model)
+    if attention_chunk_size is not None:
+        use_chunked_attention(learn.model, chunk_size=attention_chunk_size)
     return learn
 
 
+def export_inference_wide(
+    root_folder: Path,
+    weights_name: str,
+    render_factor: int = 21,
+    export_format: str = 'torchscript',
+    nf_factor: int = 2,
+    arch=models.resnet101,
+) -> Path:
+    learn = gen_inference_wide(
+        root_folder=root_folder, weights_name=weights_name, nf_factor=nf_factor, arch=arch
+    )
+    return export_learner(learn, render_factor=render_factor, export_format=export_format, name=weights_name)
+
+
 def gen_learner_wide(
-    data: ImageDataBunch, gen_loss, arch=models.resnet101, nf_factor: int = 2
+    data: ImageDataBunch, gen_loss, arch=models.resnet101, nf_factor: int = 2,
+    pretrained: bool = True, encoder_sizes: Sizes = None
 ) -> Learner:
     return unet_learner_wide(
         data,
         arch=arch,
+        pretrained=pretrained,
+        encoder_sizes=encoder_sizes,
         wd=1e-3,
         blur=True,
         norm_type=NormType.Spectral,
@@ -51,6 +108,7 @@ def unet_learner_wide(
     last_cross: bool = True,
     bottle: bool = False,
     nf_factor: int = 1,
+    encoder_sizes: Sizes = None,
     **kwargs: Any
 ) -> Learner:
     "Build Unet learner from `data` and `arch`."
@@ -68,6 +126,7 @@ def unet_learner_wide(
             last_cross=last_cross,
             bottle=bottle,
             nf_factor=nf_factor,
+            sfs_szs=encoder_sizes,
         ),
         data.device,
     )
@@ -83,23 +142,54 @@ def unet_learner_wide(
 
 # Weights are implicitly read from ./models/ folder
 def gen_inference_deep(
-    root_folder: Path, weights_name: str, arch=models.resnet34, nf_factor: float = 1.5) -> Learner:
-    data = get_dummy_databunch()
+    root_folder: Path, weights_name: str, arch=models.resnet34, nf_factor: float = 1.5, optimize: bool = False,
+    attention_chunk_size: int = None, fast: bool = False, mmap_weights: bool = False) -> Learner:
+    # See `gen_inference_wide` for what `fast` skips and `mmap_weights` does.
+    data = get_inference_databunch() if fast else get_dummy_databunch()
     learn = gen_learner_deep(
-        data=data, gen_loss=F.l1_loss, arch=arch, nf_factor=nf_factor
+        data=data,
+        gen_loss=F.l1_loss,
+        arch=arch,
+        nf_factor=nf_factor,
+        pretrained=not fast,
+        encoder_sizes=get_encoder_sizes(arch) if fast else None,
     )
     learn.path = root_folder
-    learn.load(weights_name)
+    if mmap_weights:
+        load_learner_flat(learn, weights_name)
+    else:
+        learn.load(weights_name, purge=not fast)
     learn.model.eval()
+    if optimize:
+        optimize_for_inference(learn.model)
+    if attention_chunk_size is not None:
+        use_chunked_attention(learn.model, chunk_size=attention_chunk_size)
     return learn
 
 
+def export_inference_deep(
+    root_folder: Path,
+    weights_name: str,
+    render_factor: int = 35,
+    export_format: str = 'torchscript',
+    arch=models.resnet34,
+    nf_factor: float = 1.5,
+) -> Path:
+    learn = gen_inference_deep(
+        root_folder=root_folder, weights_name=weights_name, arch=arch, nf_factor=nf_factor
+    )
+    return export_learner(learn, render_factor=render_factor, export_format=export_format, name=weights_name)
+
+
 def gen_learner_deep(
-    data: ImageDataBunch, gen_loss, arch=models.resnet34, nf_factor: float = 1.5
+    data: ImageDataBunch, gen_loss, arch=models.resnet34, nf_factor: float = 1.5,
+    pretrained: bool = True, encoder_sizes: Sizes = None
 ) -> Learner:
     return unet_learner_deep(
         data,
         arch,
+        pretrained=pretrained,
+        encoder_sizes=encoder_sizes,
         wd=1e-3,
         blur=True,
         norm_type=NormType.Spectral,
@@ -124,6 +214,7 @@ def unet_learner_deep(
     last_cross: bool = True,
     bottle: bool = False,
     nf_factor: float = 1.5,
+    encoder_sizes: Sizes = None,
     **kwargs: Any
 ) -> Learner:
     "Build Unet learner from `data` and `arch`."
@@ -141,6 +232,7 @@ def unet_learner_deep(
             last_cross=last_cross,
             bottle=bottle,
             nf_factor=nf_factor,
+            sfs_szs=encoder_sizes,
         ),
         data.device,
     )
@@ -153,3 +245,35 @@ def unet_learner_deep(
 
 
 # -----------------------------
+
+# Exported artifacts are written next to the weights in ./models/.  They take the same
+# imagenet-normalized NCHW input as the generator and return its (normalized) output.
+# Shape dependent branches are fixed at trace time, so export at the render_factor you serve.
+def export_learner(
+    learn: Learner, render_factor: int, export_format: str = 'torchscript', name: str = None, render_base: int = 16
+) -> Path:
+    "Export the generator of `learn` as a self-contained TorchScript (`.pt`) or ONNX (`.onnx`) file."
+    if export_format not in ('torchscript', 'onnx'):
+        raise ValueError('Unknown export_format: ' + str(export_format))
+
+    model = ExplicitSkipUnet(learn.model).eval()
+    sz = render_factor * render_base
+    x = torch.zeros(1, 3, sz, sz, device=next(model.parameters()).device)
+    suffix = '.pt' if export_format == 'torchscript' else '.onnx'
+    path = Path(learn.path) / learn.model_dir / '{}_{}{}'.format(ifnone(name, 'generator'), sz, suffix)
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    with torch.no_grad():
+        if export_format == 'torchscript':
+            torch.jit.trace(model, x).save(str(path))
+        else:
+            torch.onnx.export(
+                model,
+                x,
+                str(path),
+                input_names=['input'],
+                output_names=['output'],
+                dynamic_axes={'input': {0: 'batch'}, 'output': {0: 'batch'}},
+                opset_version=11,
+            )
+    return path
@@ -0,0 +1,77 @@
+"""Import-time check for `deoldify.visualize`.
+
+Runs `import deoldify.visualize` in fresh interpreters, reports the best time and fails if any of
+the optional, lazily imported dependencies got loaded or the import is too slow:
+
+    python -m deoldify.import_benchmark --max-overhead-seconds 1
+
+Most of the import is torch and fastai, whose time varies a lot between machines, so they are
+imported first and timed separately.  `--max-overhead-seconds` budgets only what deoldify adds on
+top of them, which is what a regression in this package shows up in.  `--max-seconds` budgets the
+whole import.
+"""
+import argparse
+import json
+import subprocess
+import sys
+
+LAZY_MODULES = ['yt_dlp', 'IPython', 'ffmpeg']
+
+_PROBE = '''
+import json, sys, time
+start = time.perf_counter()
+import fastai.vision
+baseline = time.perf_counter()
+import deoldify.visualize
+end = time.perf_counter()
+print(json.dumps({
+    'seconds': end - start,
+    'overhead_seconds': end - baseline,
+    'loaded': [m for m in %r if m in sys.modules],
+}))
+'''
+
+
+def measure(repeat: int = 3) -> dict:
+    """Best-of-`repeat` import time of `deoldify.visualize`, in total and on top of fastai, and which
+    lazy modules it loaded."""
+    results = []
+    for _ in range(repeat):
+        out = subprocess.run(
+            [sys.executable, '-c', _PROBE % LAZY_MODULES],
+            check=True,
+            stdout=subprocess.PIPE,
+            universal_newlines=True,
+        ).stdout
+        results.append(json.loads(out.strip().splitlines()[-1]))
+    return min(results, key=lambda r: r['seconds'])
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--max-seconds', type=float, default=None)
+    parser.add_argument('--max-overhead-seconds', type=float, default=None)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args(argv)
+
+    result = measure(args.repeat)
+    print(
+        'import deoldify.visualize: {0:.2f}s ({1:.2f}s on top of fastai.vision)'.format(
+            result['seconds'], result['overhead_seconds']
+        )
+    )
+    failed = False
+    if result['loaded']:
+        print('eagerly imported optional modules: ' + ', '.join(result['loaded']))
+        failed = True
+    if args.max_seconds is not None and result['seconds'] > args.max_seconds:
+        print('slower than the {0:.2f}s budget'.format(args.max_seconds))
+        failed = True
+    if args.max_overhead_seconds is not None and result['overhead_seconds'] > args.max_overhead_seconds:
+        print('deoldify adds more than the {0:.2f}s budget'.format(args.max_overhead_seconds))
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,208 @@
+"""Per-stage timing and allocation instrumentation.
+
+The filters, `ModelImageVisualizer` and `VideoColorizer` wrap their stages in `stage(name)`.
+Nothing is recorded until a sink is installed:
+
+    sink = HistogramSink()
+    set_sink(sink)               # or `with instrumented(sink): ...`
+    vis.get_transformed_image(path)
+    print(sink.to_prometheus())
+
+With no sink, `stage` returns a shared no-op context manager, so the cost is one function call.
+
+Stages: `open_image`, `scale_to_square`, `to_tensor`, `forward`, `denorm`, `unsquare`,
+`post_process`, `filter` (the whole filter chain), `watermark`, `save`, and for video
+`extract_frames`, `colorize_frames` and `build_video`.  Stages nest, so `filter` includes the
+model stages inside it.
+
+Allocations are measured with `torch.cuda.memory_allocated`, so they are only recorded on the
+GPU.  On the CPU torch allocates outside the Python heap, where neither `tracemalloc` nor
+anything else cheap can see it, so `nbytes` is None there rather than a misleading number.
+"""
+import bisect
+import contextlib
+import logging
+import sys
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+from typing import Dict, Optional
+
+
+_sink = None
+_null_stage = contextlib.nullcontext()
+
+
+class Sink(ABC):
+    @abstractmethod
+    def record(self, stage: str, seconds: float, nbytes: Optional[int]):
+        "`nbytes` is the net CUDA memory allocated during the stage, or None off the GPU."
+        pass
+
+
+def set_sink(sink: Optional[Sink]):
+    "Install `sink` for all stages; `None` turns instrumentation off."
+    global _sink
+    _sink = sink
+
+
+def get_sink() -> Optional[Sink]:
+    return _sink
+
+
+@contextlib.contextmanager
+def instrumented(sink: Sink):
+    "Record stages into `sink` for the duration of the block."
+    previous = get_sink()
+    set_sink(sink)
+    try:
+        yield sink
+    finally:
+        set_sink(previous)
+
+
+def _cuda():
+    # Never import torch from here; only look at CUDA if someone else already brought it up.
+    torch = sys.modules.get('torch')
+    if torch is not None and torch.cuda.is_available() and torch.cuda.is_initialized():
+        return torch.cuda
+    return None
+
+
+def _allocated_bytes(cuda) -> Optional[int]:
+    # Only CUDA allocations are visible; see the module docstring.
+    return cuda.memory_allocated() if cuda is not None else None
+
+
+class _Stage:
+    __slots__ = ('sink', 'name', 'cuda', 'start', 'start_bytes')
+
+    def __init__(self, sink: Sink, name: str):
+        self.sink = sink
+        self.name = name
+
+    def __enter__(self):
+        self.cuda = _cuda()
+        if self.cuda is not None:
+            # CUDA work is asynchronous; without syncing, time would land in whichever stage waits on it.
+            self.cuda.synchronize()
+        self.start_bytes = _allocated_bytes(self.cuda)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self.cuda is not None:
+            self.cuda.synchronize()
+        seconds = time.perf_counter() - self.start
+        end_bytes = _allocated_bytes(self.cuda)
+        nbytes = None if end_bytes is None or self.start_bytes is None else end_bytes - self.start_bytes
+        self.sink.record(self.name, seconds, nbytes)
+        return False
+
+
+def stage(name: str):
+    "Context manager timing the stage `name` into the installed sink, if any."
+    sink = _sink
+    if sink is None:
+        return _null_stage
+    return _Stage(sink, name)
+
+
+class LoggingSink(Sink):
+    def __init__(self, level: int = logging.INFO):
+        self.level = level
+
+    def record(self, stage: str, seconds: float, nbytes: Optional[int]):
+        message = '{0}: {1:.2f} ms'.format(stage, seconds * 1000)
+        if nbytes is not None:
+            message += ', {0:+.1f} MB allocated'.format(nbytes / 2 ** 20)
+        logging.log(self.level, message)
+
+
+class MultiSink(Sink):
+    def __init__(self, *sinks: Sink):
+        self.sinks = sinks
+
+    def record(self, stage: str, seconds: float, nbytes: Optional[int]):
+        for sink in self.sinks:
+            sink.record(stage, seconds, nbytes)
+
+
+class _StageHistogram:
+    def __init__(self, buckets, window: int):
+        self.bucket_counts = [0] * len(buckets)
+        self.count = 0
+        self.total_seconds = 0.0
+        self.total_bytes = 0
+        self.recent = deque(maxlen=window)
+
+
+class HistogramSink(Sink):
+    """Keeps a cumulative latency histogram per stage, plus a window of recent samples for
+    percentiles, and can export both in the Prometheus text exposition format."""
+
+    default_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, buckets=default_buckets, window: int = 1000):
+        self.buckets = tuple(sorted(buckets))
+        self.window = window
+        self._lock = threading.Lock()
+        self.stages: Dict[str, _StageHistogram] = {}
+
+    def record(self, stage: str, seconds: float, nbytes: Optional[int]):
+        with self._lock:
+            histogram = self.stages.get(stage)
+            if histogram is None:
+                histogram = self.stages[stage] = _StageHistogram(self.buckets, self.window)
+            index = bisect.bisect_left(self.buckets, seconds)
+            if index < len(self.buckets):
+                histogram.bucket_counts[index] += 1
+            histogram.count += 1
+            histogram.total_seconds += seconds
+            if nbytes is not None:
+                histogram.total_bytes += nbytes
+            histogram.recent.append(seconds)
+
+    def reset(self):
+        with self._lock:
+            self.stages = {}
+
+    def summary(self) -> Dict[str, dict]:
+        "Count, mean and recent p50/p90/p99 seconds, and net CUDA bytes allocated (0 on CPU), per stage."
+        result = {}
+        with self._lock:
+            for name, histogram in self.stages.items():
+                recent = sorted(histogram.recent)
+                percentile = lambda q: recent[min(len(recent) - 1, int(q * len(recent)))]
+                result[name] = {
+                    'count': histogram.count,
+                    'mean': histogram.total_seconds / histogram.count,
+                    'p50': percentile(0.5),
+                    'p90': percentile(0.9),
+                    'p99': percentile(0.99),
+                    'allocated_bytes': histogram.total_bytes,
+                }
+        return result
+
+    def to_prometheus(self, prefix: str = 'deoldify') -> str:
+        lines = [
+            '# HELP {0}_stage_seconds Time spent per processing stage.'.format(prefix),
+            '# TYPE {0}_stage_seconds histogram'.format(prefix),
+        ]
+        with self._lock:
+            stages = sorted(self.stages.items())
+            for name, histogram in stages:
+                cumulative = 0
+                for bound, count in zip(self.buckets, histogram.bucket_counts):
+                    cumulative += count
+                    lines.append('{0}_stage_seconds_bucket{{stage="{1}",le="{2}"}} {3}'.format(prefix, name, bound, cumulative))
+                lines.append('{0}_stage_seconds_bucket{{stage="{1}",le="+Inf"}} {2}'.format(prefix, name, histogram.count))
+                lines.append('{0}_stage_seconds_sum{{stage="{1}"}} {2}'.format(prefix, name, histogram.total_seconds))
+                lines.append('{0}_stage_seconds_count{{stage="{1}"}} {2}'.format(prefix, name, histogram.count))
+            # Net allocations can be negative, so this is a gauge rather than a counter.  CUDA only.
+            lines.append('# HELP {0}_stage_allocated_bytes Net CUDA bytes allocated per processing stage.'.format(prefix))
+            lines.append('# TYPE {0}_stage_allocated_bytes gauge'.format(prefix))
+            for name, histogram in stages:
+                lines.append('{0}_stage_allocated_bytes{{stage="{1}"}} {2}'.format(prefix, name, histogram.total_bytes))
+        return '\n'.join(lines) + '\n'
@@ -44,3 +44,38 @@ def custom_conv_layer(
     if self_attention:
         layers.append(SelfAttention(nf))
     return nn.Sequential(*layers)
+
+
+class ChunkedSelfAttention(Module):
+    "Same result as `SelfAttention`, computed over chunks of output positions so memory grows linearly with H*W."
+
+    def __init__(self, attention: SelfAttention, chunk_size: int = 1024):
+        # Reuses the modules (and parameter names) of `attention`, so weights load the same way.
+        self.query, self.key, self.value = attention.query, attention.key, attention.value
+        self.gamma = attention.gamma
+        self.chunk_size = chunk_size
+
+    def forward(self, x):
+        size = x.size()
+        x = x.view(*size[:2], -1)
+        f, g, h = self.query(x), self.key(x), self.value(x)
+        f = f.permute(0, 2, 1).contiguous()
+        # The softmax runs over dim=1 (the "f" positions), so each column of the full attention
+        # matrix is independent and only an N x chunk_size slice is ever materialized.
+        chunks = []
+        for start in range(0, x.shape[2], self.chunk_size):
+            beta = F.softmax(torch.bmm(f, g[:, :, start : start + self.chunk_size]), dim=1)
+            chunks.append(torch.bmm(h, beta))
+        o = self.gamma * torch.cat(chunks, dim=2) + x
+        return o.view(*size).contiguous()
+
+
+def use_chunked_attention(model: nn.Module, chunk_size: int = 1024) -> nn.Module:
+    "Swap every `SelfAttention` in `model` for a `ChunkedSelfAttention` sharing its weights, in place."
+    for module in list(model.modules()):
+        for name, child in module.named_children():
+            if isinstance(child, SelfAttention):
+                setattr(module, name, ChunkedSelfAttention(child, chunk_size=chunk_size))
+            elif isinstance(child, ChunkedSelfAttention):
+                child.chunk_size = chunk_size
+    return model
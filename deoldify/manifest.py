@@ -0,0 +1,78 @@
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+
+
+def file_hash(path: Path, chunk_size: int = 1 << 20) -> str:
+    "Return the sha256 hex digest of the file at `path`, read in `chunk_size` chunks."
+    digest = hashlib.sha256()
+    with open(str(path), 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class FrameManifest:
+    """Records which frames of a video job have been extracted and colorized.
+
+    The manifest is tied to the hash of the source video; colorized frames are further tied to
+    a colorize key (render factor, weights, post processing and watermark flags).  When either
+    changes, the corresponding frames are treated as stale.
+    """
+
+    def __init__(self, path: Path, source_hash: str, flush_every: int = 100):
+        self.path = Path(path)
+        self.flush_every = flush_every
+        self._lock = threading.Lock()
+        self._pending = 0
+        self.data = self._load()
+        if self.data.get('source_hash') != source_hash:
+            self.data = {'source_hash': source_hash}
+
+    def _load(self) -> dict:
+        try:
+            with open(str(self.path)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save(self):
+        with self._lock:
+            self._save()
+
+    def _save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix('.tmp')
+        with open(str(tmp_path), 'w') as f:
+            json.dump(self.data, f)
+        os.replace(str(tmp_path), str(self.path))
+        self._pending = 0
+
+    def is_extracted(self, frame_count: int) -> bool:
+        return self.data.get('extracted', False) and self.data.get('frame_count') == frame_count
+
+    def mark_extracted(self, frame_count: int):
+        with self._lock:
+            self.data['extracted'] = True
+            self.data['frame_count'] = frame_count
+            self.data.pop('colorize_key', None)
+            self.data.pop('colorized', None)
+            self._save()
+
+    def colorized_frames(self, colorize_key: dict) -> set:
+        "Frame names already colorized with `colorize_key`; resets the colorized set if the key changed."
+        with self._lock:
+            if self.data.get('colorize_key') != colorize_key:
+                self.data['colorize_key'] = colorize_key
+                self.data['colorized'] = []
+                self._save()
+            return set(self.data['colorized'])
+
+    def mark_colorized(self, frame_name: str):
+        with self._lock:
+            self.data['colorized'].append(frame_name)
+            self._pending += 1
+            if self._pending >= self.flush_every:
+                self._save()
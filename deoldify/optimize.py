@@ -0,0 +1,98 @@
+from fastai.torch_core import *
+import platform
+from torch.nn.utils import remove_spectral_norm
+from torch.nn.utils.spectral_norm import SpectralNorm
+from torchvision.models.resnet import BasicBlock, Bottleneck
+
+# Inference-only transforms for the generators.  They modify the model in place and
+# leave it unsuitable for further training.
+
+
+def fold_spectral_norm(model: nn.Module) -> nn.Module:
+    "Replace every spectral-norm reparametrization in `model` by its current normalized weight."
+    for module in model.modules():
+        if any(isinstance(hook, SpectralNorm) for hook in module._forward_pre_hooks.values()):
+            remove_spectral_norm(module)
+    return model
+
+
+def _can_fuse(conv: nn.Module, bn: nn.Module) -> bool:
+    return (
+        isinstance(conv, nn.Conv2d)
+        and isinstance(bn, nn.BatchNorm2d)
+        and bn.running_mean is not None
+        and not any(isinstance(hook, SpectralNorm) for hook in conv._forward_pre_hooks.values())
+        # Fusing would change what a hook on either module observes.
+        and len(conv._forward_hooks) == 0
+        and len(bn._forward_hooks) == 0
+    )
+
+
+def _fuse_conv_bn(conv: nn.Conv2d, bn: nn.BatchNorm2d):
+    "Fold eval-mode `bn` into the weight and bias of the `conv` feeding it, in place."
+    with torch.no_grad():
+        scale = torch.rsqrt(bn.running_var + bn.eps)
+        if bn.weight is not None:
+            scale = scale * bn.weight
+        bias = conv.bias if conv.bias is not None else torch.zeros_like(bn.running_mean)
+        bias = (bias - bn.running_mean) * scale
+        if bn.bias is not None:
+            bias = bias + bn.bias
+        # Out of place, so weights memory mapped read-only (see `flat_weights`) are left alone.
+        conv.weight = nn.Parameter(conv.weight * scale.reshape(-1, 1, 1, 1))
+        conv.bias = nn.Parameter(bias)
+
+
+def fold_batchnorm(model: nn.Module) -> nn.Module:
+    "Fuse every `BatchNorm2d` that directly follows a `Conv2d` into that conv."
+    for module in list(model.modules()):
+        if isinstance(module, nn.Sequential):
+            children = list(module._modules.items())
+            for (_, conv), (bn_name, bn) in zip(children, children[1:]):
+                if _can_fuse(conv, bn):
+                    _fuse_conv_bn(conv, bn)
+                    module._modules[bn_name] = nn.Identity()
+        elif isinstance(module, (BasicBlock, Bottleneck)):
+            for conv_name, bn_name in (('conv1', 'bn1'), ('conv2', 'bn2'), ('conv3', 'bn3')):
+                conv, bn = getattr(module, conv_name, None), getattr(module, bn_name, None)
+                if _can_fuse(conv, bn):
+                    _fuse_conv_bn(conv, bn)
+                    setattr(module, bn_name, nn.Identity())
+    return model
+
+
+def optimize_for_inference(model: nn.Module) -> nn.Module:
+    "Bake spectral norm into the conv weights and fuse conv -> batchnorm pairs of `model`, in place."
+    model.eval()
+    fold_spectral_norm(model)
+    fold_batchnorm(model)
+    return model
+
+
+def _wrap_convs(module: nn.Module, qconfig):
+    for name, child in module.named_children():
+        if type(child) is nn.Conv2d and len(child._forward_pre_hooks) == 0:
+            wrapper = torch.quantization.QuantWrapper(child)
+            wrapper.qconfig = qconfig
+            setattr(module, name, wrapper)
+        else:
+            _wrap_convs(child, qconfig)
+
+
+def quantize_convs(model: nn.Module, calibration_batches: Iterable[Tensor], backend: str = None) -> nn.Module:
+    """Post-training static int8 quantization of every `Conv2d` in `model`, in place.
+
+    Each conv is wrapped in its own quantize/dequantize pair, so the rest of the network (attention,
+    pixel shuffle, concatenations) keeps running in fp32.  Activation ranges are observed while running
+    the normalized input batches in `calibration_batches`.  CPU only.
+    """
+    backend = ifnone(backend, 'qnnpack' if platform.machine() in ('arm64', 'aarch64') else 'fbgemm')
+    torch.backends.quantized.engine = backend
+    optimize_for_inference(model)
+    _wrap_convs(model, torch.quantization.get_default_qconfig(backend))
+    torch.quantization.prepare(model, inplace=True)
+    with torch.no_grad():
+        for x in calibration_batches:
+            model(x)
+    torch.quantization.convert(model, inplace=True)
+    return model
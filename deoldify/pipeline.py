@@ -0,0 +1,157 @@
+import threading
+from pathlib import Path
+from queue import Queue
+from typing import Callable, Iterable, List, Tuple
+
+from PIL import Image
+
+from .instrument import stage
+
+
+_DONE = object()
+
+
+class FramePipeline:
+    """Producer/consumer frame executor: decode -> colorize -> finish/save.
+
+    Decoding and finishing (watermarking, encoding, saving) run in their own thread pools
+    while the calling thread drives the model, so PIL/cv2 work overlaps the generator forward.
+    Stages are connected by bounded queues, giving back-pressure when the model falls behind
+    (or gets ahead of) the I/O workers.  Decoders can finish out of order, so decoded frames are
+    put back in job order before they reach the model; the chroma reuse filters depend on it.
+    """
+
+    def __init__(
+        self,
+        decode_workers: int = 2,
+        save_workers: int = 2,
+        queue_size: int = 16,
+        batch_size: int = 1,
+    ):
+        self.decode_workers = max(1, decode_workers)
+        self.save_workers = max(1, save_workers)
+        self.queue_size = max(1, queue_size)
+        self.batch_size = max(1, batch_size)
+
+    def run(
+        self,
+        vis,
+        jobs: Iterable[Tuple[Path, Path]],
+        render_factor: int = None,
+        post_process: bool = True,
+        finish: Callable[[Image.Image], Image.Image] = None,
+        on_saved: Callable[[Path], None] = None,
+    ) -> int:
+        "Colorize every `(source, dest)` pair in `jobs` with `vis`, returning the number of frames written."
+        jobs = enumerate(jobs)
+        jobs_lock = threading.Lock()
+        decoded = Queue(maxsize=self.queue_size)
+        colorized = Queue(maxsize=self.queue_size)
+        # Bounds the frames decoded but not yet handed to the model, including those held back for reordering.
+        ahead = threading.Semaphore(self.queue_size)
+        errors = []
+
+        def next_job():
+            while not ahead.acquire(timeout=0.1):
+                if errors:
+                    return None
+            with jobs_lock:
+                job = next(jobs, None)
+            if job is None:
+                ahead.release()
+            return job
+
+        def decode():
+            try:
+                job = next_job()
+                while job is not None and not errors:
+                    index, (source, dest) = job
+                    decoded.put((index, dest, vis._open_pil_image(source)))
+                    job = next_job()
+            except Exception as e:
+                errors.append(e)
+            finally:
+                decoded.put(_DONE)
+
+        def save():
+            while True:
+                item = colorized.get()
+                if item is _DONE:
+                    return
+                # Keep draining after a failure so the model stage never blocks on a full queue.
+                if errors:
+                    continue
+                dest, image = item
+                try:
+                    if finish is not None:
+                        image = finish(image)
+                    with stage('save'):
+                        image.save(str(dest))
+                    if on_saved is not None:
+                        on_saved(dest)
+                except Exception as e:
+                    errors.append(e)
+
+        workers = [threading.Thread(target=decode, daemon=True) for _ in range(self.decode_workers)]
+        workers += [threading.Thread(target=save, daemon=True) for _ in range(self.save_workers)]
+        for worker in workers:
+            worker.start()
+
+        count = 0
+        finished_decoders = 0
+        batch = []
+        waiting = {}
+        next_index = 0
+        try:
+            while finished_decoders < self.decode_workers:
+                item = decoded.get()
+                if item is _DONE:
+                    finished_decoders += 1
+                elif not errors:
+                    index, dest, image = item
+                    waiting[index] = (dest, image)
+                    while next_index in waiting:
+                        batch.append(waiting.pop(next_index))
+                        next_index += 1
+                        ahead.release()
+
+                flush = len(batch) >= self.batch_size or finished_decoders == self.decode_workers
+                if batch and flush:
+                    try:
+                        self._colorize_batch(vis, batch, colorized, render_factor, post_process)
+                        count += len(batch)
+                    except Exception as e:
+                        errors.append(e)
+                    batch = []
+        except BaseException as e:
+            errors.append(e)
+            raise
+        finally:
+            # Unblock any decoder still waiting on a full queue before joining.
+            while finished_decoders < self.decode_workers:
+                if decoded.get() is _DONE:
+                    finished_decoders += 1
+            for _ in range(self.save_workers):
+                colorized.put(_DONE)
+            for worker in workers:
+                worker.join()
+
+        if errors:
+            raise errors[0]
+        return count
+
+    def _colorize_batch(
+        self,
+        vis,
+        batch: List[Tuple[Path, Image.Image]],
+        colorized: Queue,
+        render_factor: int,
+        post_process: bool,
+    ):
+        dests = [dest for dest, _ in batch]
+        images = [image for _, image in batch]
+        results = vis.get_transformed_pil_images(
+            images, render_factor=render_factor, post_process=post_process, watermarked=False
+        )
+        for dest, result in zip(dests, results):
+            colorized.put((dest, result))
@@ -0,0 +1,204 @@
+import logging
+import os
+from dataclasses import dataclass
+
+from fastai.torch_core import *
+from .layers import ChunkedSelfAttention, SelfAttention
+
+
+@dataclass
+class RenderPlan:
+    render_factor: int
+    batch_size: int
+    estimated_bytes: int
+    budget_bytes: int
+
+    @property
+    def feasible(self) -> bool:
+        return self.estimated_bytes <= self.budget_bytes
+
+
+def available_memory(device: torch.device) -> int:
+    "Bytes that can still be allocated on `device`."
+    if device.type == 'cuda':
+        if hasattr(torch.cuda, 'mem_get_info'):
+            return torch.cuda.mem_get_info(device)[0]
+        total = torch.cuda.get_device_properties(device).total_memory
+        return total - torch.cuda.memory_reserved(device)
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+
+
+class RenderPlanner:
+    """Predicts the peak activation memory of a generator forward pass for a given render size.
+
+    The model is profiled once with square inputs at `probe_factors`, and the peak is fitted as
+    `c0 + c1 * pixels + c2 * pixels**2` (the quadratic term comes from self attention).  On GPU
+    the peak is measured with the CUDA allocator statistics; on CPU it's estimated from the sizes
+    of the activations seen by forward hooks.
+
+    The default probes span the render factors the notebooks offer (up to 40).  The fit is only
+    trusted between the smallest and largest probe that ran: larger render factors are never
+    extrapolated to, and a probe that runs out of memory ends the range below it.
+    """
+
+    def __init__(
+        self,
+        model: nn.Module,
+        render_base: int = 16,
+        probe_factors: Collection[int] = (7, 24, 40),
+        safety: float = 0.8,
+        min_render_factor: int = 7,
+    ):
+        self.model = model
+        self.render_base = render_base
+        self.probe_factors = probe_factors
+        self.safety = safety
+        self.min_render_factor = min_render_factor
+        self.coeffs = None
+        self.max_render_factor = None
+
+    @property
+    def device(self) -> torch.device:
+        return next(self.model.parameters()).device
+
+    def _measure_cuda(self, x: Tensor) -> int:
+        torch.cuda.synchronize(self.device)
+        baseline = torch.cuda.memory_allocated(self.device)
+        torch.cuda.reset_peak_memory_stats(self.device)
+        with torch.no_grad():
+            self.model(x)
+        torch.cuda.synchronize(self.device)
+        return torch.cuda.max_memory_allocated(self.device) - baseline
+
+    def _estimate_cpu(self, x: Tensor) -> int:
+        retained = []
+        transient = [0]
+
+        def nbytes(t) -> int:
+            return t.numel() * t.element_size() if isinstance(t, Tensor) else 0
+
+        def on_forward(module, input, output):
+            size = sum(nbytes(i) for i in input) + nbytes(output)
+            if isinstance(module, (SelfAttention, ChunkedSelfAttention)):
+                b, n = output.shape[0], output.shape[2] * output.shape[3]
+                cols = min(n, module.chunk_size) if isinstance(module, ChunkedSelfAttention) else n
+                # attention logits and their softmax
+                size += 2 * b * n * cols * output.element_size()
+            transient[0] = max(transient[0], size)
+
+        def on_retained(module, input, output):
+            retained.append(nbytes(output))
+
+        skip_modules = []
+        if hasattr(self.model, 'sfs_idxs'):
+            skip_modules = [self.model.layers[0][i] for i in self.model.sfs_idxs]
+        handles = []
+        for module in self.model.modules():
+            if len(list(module.children())) == 0 or isinstance(module, (SelfAttention, ChunkedSelfAttention)):
+                handles.append(module.register_forward_hook(on_forward))
+        handles += [module.register_forward_hook(on_retained) for module in skip_modules]
+        try:
+            with torch.no_grad():
+                self.model(x)
+        finally:
+            for handle in handles:
+                handle.remove()
+        return nbytes(x) + sum(retained) + transient[0]
+
+    def _probe(self, factor: int) -> Optional[int]:
+        "Peak bytes for one image at `factor`, or None if it ran out of memory."
+        sz = factor * self.render_base
+        try:
+            x = torch.zeros(1, 3, sz, sz, device=self.device)
+            return self._measure_cuda(x) if self.device.type == 'cuda' else self._estimate_cpu(x)
+        except RuntimeError as rerr:
+            if 'memory' not in str(rerr):
+                raise rerr
+            if self.device.type == 'cuda':
+                torch.cuda.empty_cache()
+            return None
+
+    def profile(self):
+        """Fit the memory model and set `max_render_factor`, the largest probe that ran; only runs
+        the probe forward passes the first time."""
+        if self.coeffs is not None:
+            return self.coeffs
+        pixels, peaks = [], []
+        for factor in sorted(self.probe_factors):
+            peak = self._probe(factor)
+            if peak is None:
+                logging.warning('Render planner probe at render_factor {0} ran out of memory.'.format(factor))
+                break
+            self.max_render_factor = factor
+            pixels.append(float((factor * self.render_base) ** 2))
+            peaks.append(float(peak))
+        if len(pixels) == 0:
+            raise RuntimeError(
+                'Render planner could not run the model even at render_factor {0}.'.format(min(self.probe_factors))
+            )
+        # With fewer probes than coefficients, drop the higher order terms rather than guess them.
+        degree = min(3, len(pixels))
+        a = np.array([[p ** k for k in range(degree)] for p in pixels])
+        coeffs = np.linalg.lstsq(a, np.array(peaks), rcond=None)[0]
+        self.coeffs = np.concatenate([coeffs, np.zeros(3 - degree)])
+        logging.info(
+            'Render planner memory model (bytes vs pixels, up to render_factor {0}): {1}'.format(
+                self.max_render_factor, self.coeffs
+            )
+        )
+        return self.coeffs
+
+    def estimate_bytes(self, render_factor: int, batch_size: int = 1) -> int:
+        "Estimated peak bytes; raises ValueError above `max_render_factor`, where the fit isn't trusted."
+        c0, c1, c2 = self.profile()
+        if render_factor > self.max_render_factor:
+            raise ValueError(
+                'render_factor {0} is beyond the profiled range (up to {1}); add a larger probe factor.'.format(
+                    render_factor, self.max_render_factor
+                )
+            )
+        pixels = float((render_factor * self.render_base) ** 2)
+        return int(max(0.0, c0) + batch_size * max(0.0, c1 * pixels + c2 * pixels * pixels))
+
+    def budget_bytes(self) -> int:
+        return int(available_memory(self.device) * self.safety)
+
+    def plan(self, render_factor: Optional[int], batch_size: int = 1, budget_bytes: int = None) -> RenderPlan:
+        """Plan for the largest render factor up to `render_factor` that fits the memory budget at
+        `batch_size`.  A `render_factor` of None asks for the largest that fits, and one above
+        `max_render_factor` is capped there.  `budget_bytes` defaults to `budget_bytes()`.  If even
+        `min_render_factor` doesn't fit, the returned plan is not `feasible`."""
+        if budget_bytes is None:
+            budget_bytes = self.budget_bytes()
+        self.profile()
+        if render_factor is None:
+            render_factor = self.max_render_factor
+        elif render_factor > self.max_render_factor:
+            logging.warning(
+                'render_factor {0} is beyond the profiled range; planning for {1} instead.'.format(
+                    render_factor, self.max_render_factor
+                )
+            )
+            render_factor = self.max_render_factor
+        for factor in range(render_factor, min(render_factor, self.min_render_factor) - 1, -1):
+            estimate = self.estimate_bytes(factor, batch_size)
+            if estimate <= budget_bytes:
+                return RenderPlan(factor, batch_size, estimate, budget_bytes)
+        return RenderPlan(render_factor, batch_size, self.estimate_bytes(render_factor, batch_size), budget_bytes)
+
+    def max_batch_size(self, render_factor: int, budget_bytes: int = None) -> int:
+        "Largest batch size at `render_factor` that fits the memory budget (0 if none does)."
+        if budget_bytes is None:
+            budget_bytes = self.budget_bytes()
+        c0, _, _ = self.profile()
+        per_image = self.estimate_bytes(render_factor, 1) - max(0.0, c0)
+        if per_image <= 0:
+            return 1
+        return max(0, int((budget_bytes - max(0.0, c0)) // per_image))
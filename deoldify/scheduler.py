@@ -0,0 +1,146 @@
+import logging
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Iterable, List, Optional, Union
+
+from .manifest import FrameManifest
+from .visualize import VideoColorizer
+
+
+@dataclass
+class ClipResult:
+    source_path: Path
+    status: str = 'pending'
+    result_path: Optional[Path] = None
+    frames: int = 0
+    colorize_seconds: float = 0.0
+    error: Optional[str] = None
+
+    @property
+    def fps(self) -> float:
+        return self.frames / self.colorize_seconds if self.colorize_seconds > 0 else 0.0
+
+
+class BatchVideoScheduler:
+    """Colorizes many clips with the one generator loaded in `colorizer`.
+
+    The model only ever works on one clip at a time, but frame extraction of the next clip and
+    encoding of the previous one run in background threads meanwhile, so the model isn't left
+    waiting on ffmpeg between clips.  A failure in any stage only fails that clip.
+    """
+
+    def __init__(
+        self,
+        colorizer: VideoColorizer,
+        render_factor: int = None,
+        post_process: bool = True,
+        watermarked: bool = True,
+        resume: bool = True,
+        on_clip_done: Callable[[ClipResult], None] = None,
+    ):
+        # `on_clip_done` is called as each clip finishes or fails; for finished clips that's on the encoder thread.
+        self.colorizer = colorizer
+        self.render_factor = render_factor
+        self.post_process = post_process
+        self.watermarked = watermarked
+        self.resume = resume
+        self.on_clip_done = on_clip_done
+
+    def _resolve(self, source: Union[str, Path]) -> Path:
+        # Bare file names refer to the colorizer's source folder, like `colorize_from_file_name`.
+        source = Path(source)
+        return source if source.parent != Path('.') else self.colorizer.source_folder / source
+
+    def _extract(self, source_path: Path) -> Optional[FrameManifest]:
+        if not source_path.exists():
+            raise Exception('Video at path specfied, ' + str(source_path) + ' could not be found.')
+        manifest = self.colorizer._get_manifest(source_path) if self.resume else None
+        self.colorizer._extract_raw_frames(source_path, manifest=manifest)
+        return manifest
+
+    def _colorize(self, clip: ClipResult, manifest: Optional[FrameManifest]):
+        # Only frames colorized in this run count, so resumed clips don't inflate the fps.
+        start = time.perf_counter()
+        clip.frames = self.colorizer._colorize_raw_frames(
+            clip.source_path, render_factor=self.render_factor, post_process=self.post_process,
+            watermarked=self.watermarked, manifest=manifest,
+        )
+        clip.colorize_seconds = time.perf_counter() - start
+
+    def _fail(self, clip: ClipResult, stage: str, e: Exception):
+        logging.error('Failed to {0} {1}: {2}'.format(stage, clip.source_path, e), exc_info=True)
+        clip.status = 'failed'
+        clip.error = '{0}: {1}'.format(stage, e)
+        self._finish(clip)
+
+    def _finish(self, clip: ClipResult):
+        if self.on_clip_done is not None:
+            self.on_clip_done(clip)
+
+    def _encoded(self, clip: ClipResult, encoding: Future):
+        # Runs on the encoder thread as soon as the clip's encode ends.
+        try:
+            clip.result_path = encoding.result()
+        except Exception as e:
+            self._fail(clip, 'encode', e)
+            return
+        clip.status = 'done'
+        logging.info('Finished {0}: {1}'.format(clip.source_path.name, clip.result_path))
+        self._finish(clip)
+
+    def run(self, sources: Iterable[Union[str, Path]]) -> List[ClipResult]:
+        "Colorize each of `sources` (paths, or file names in the colorizer's source folder) in order."
+        clips = [ClipResult(self._resolve(source)) for source in sources]
+        if len(clips) == 0:
+            return clips
+        start = time.perf_counter()
+
+        with ThreadPoolExecutor(max_workers=1) as extractor, ThreadPoolExecutor(max_workers=1) as encoder:
+            extractions = {0: extractor.submit(self._extract, clips[0].source_path)}
+            for k, clip in enumerate(clips):
+                if k + 1 < len(clips):
+                    extractions[k + 1] = extractor.submit(self._extract, clips[k + 1].source_path)
+                try:
+                    manifest = extractions.pop(k).result()
+                except Exception as e:
+                    self._fail(clip, 'extract frames of', e)
+                    continue
+
+                clip.status = 'colorizing'
+                logging.info('Colorizing clip {0}/{1}: {2}'.format(k + 1, len(clips), clip.source_path))
+                try:
+                    self._colorize(clip, manifest)
+                except Exception as e:
+                    self._fail(clip, 'colorize', e)
+                    continue
+                logging.info(
+                    'Colorized {0} frames of {1} in {2:.1f}s ({3:.2f} fps)'.format(
+                        clip.frames, clip.source_path.name, clip.colorize_seconds, clip.fps
+                    )
+                )
+                clip.status = 'encoding'
+                encoding = encoder.submit(self.colorizer._build_video, clip.source_path)
+                encoding.add_done_callback(lambda encoding, clip=clip: self._encoded(clip, encoding))
+            # Leaving the block waits for the last encodes.
+
+        self._report(clips, time.perf_counter() - start)
+        return clips
+
+    def run_directory(self, folder: Path = None, pattern: str = '*.mp4') -> List[ClipResult]:
+        "Colorize every file matching `pattern` in `folder` (the colorizer's source folder by default)."
+        folder = Path(folder) if folder is not None else self.colorizer.source_folder
+        return self.run(sorted(folder.glob(pattern)))
+
+    def _report(self, clips: List[ClipResult], seconds: float):
+        done = [clip for clip in clips if clip.status == 'done']
+        failed = [clip for clip in clips if clip.status == 'failed']
+        frames = sum(clip.frames for clip in done)
+        logging.info(
+            'Batch finished: {0} clips done, {1} failed, {2} frames in {3:.1f}s ({4:.2f} fps overall)'.format(
+                len(done), len(failed), frames, seconds, frames / seconds if seconds > 0 else 0.0
+            )
+        )
+        for clip in failed:
+            logging.info('  failed: {0} ({1})'.format(clip.source_path, clip.error))
@@ -0,0 +1,175 @@
+import contextlib
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import List, Optional, Set
+
+
+@dataclass
+class SegmentJob:
+    "One independently colorizable piece of a video, as produced by `VideoColorizer.split_into_segment_jobs`."
+    job_id: str
+    parent: str
+    index: int
+    source: str
+    output: str
+    render_factor: Optional[int] = None
+    post_process: bool = True
+    watermarked: bool = True
+    weights_name: Optional[str] = None
+
+    def to_json(self) -> str:
+        return json.dumps(asdict(self))
+
+    @classmethod
+    def from_json(cls, text: str) -> 'SegmentJob':
+        return cls(**json.loads(text))
+
+
+class FileJobQueue:
+    """A job queue that is just a directory, so any worker that can see it (locally or over a shared
+    filesystem) can take part.  Jobs move `pending/ -> running/ -> done/` (or `failed/`) by
+    `os.rename`, which is atomic, so two workers can't claim the same job.
+
+    A claimed job is leased: its worker keeps bumping the `running/` file's modification time
+    (see `lease`), and a running job whose file hasn't been touched for `lease_seconds` is
+    assumed to belong to a dead worker and goes back to `pending/`.
+    """
+
+    states = ('pending', 'running', 'done', 'failed')
+
+    def __init__(self, root: Path, lease_seconds: float = 300):
+        self.root = Path(root)
+        self.lease_seconds = lease_seconds
+        for state in self.states:
+            (self.root / state).mkdir(parents=True, exist_ok=True)
+
+    def _path(self, state: str, job_id: str) -> Path:
+        return self.root / state / (job_id + '.json')
+
+    def _write(self, path: Path, text: str):
+        tmp_path = path.with_suffix('.tmp')
+        with open(str(tmp_path), 'w') as f:
+            f.write(text)
+        os.replace(str(tmp_path), str(path))
+
+    def _remove(self, state: str, job_id: str):
+        try:
+            self._path(state, job_id).unlink()
+        except FileNotFoundError:
+            pass
+
+    def put(self, job: SegmentJob):
+        for state in self.states:
+            if state != 'pending':
+                self._remove(state, job.job_id)
+        self._write(self._path('pending', job.job_id), job.to_json())
+
+    def claim(self, exclude: Set[str] = frozenset()) -> Optional[SegmentJob]:
+        "Take the oldest pending job not in `exclude`, or return None if there are none."
+        self.requeue_stale()
+        for path in sorted((self.root / 'pending').glob('*.json')):
+            if path.stem in exclude:
+                continue
+            running_path = self._path('running', path.stem)
+            try:
+                # Start the lease before the rename, so the job never shows up in running/ looking stale.
+                os.utime(str(path))
+                os.rename(str(path), str(running_path))
+            except FileNotFoundError:
+                # Another worker got there first.
+                continue
+            with open(str(running_path)) as f:
+                return SegmentJob.from_json(f.read())
+        return None
+
+    def release(self, job: SegmentJob):
+        "Give a claimed job back, untouched, for another worker to take."
+        try:
+            os.rename(str(self._path('running', job.job_id)), str(self._path('pending', job.job_id)))
+        except FileNotFoundError:
+            pass
+
+    def heartbeat(self, job: SegmentJob):
+        try:
+            os.utime(str(self._path('running', job.job_id)))
+        except FileNotFoundError:
+            pass
+
+    @contextlib.contextmanager
+    def lease(self, job: SegmentJob):
+        "Keep `job`'s lease alive from a background thread while the block runs."
+        stop = threading.Event()
+
+        def beat():
+            while not stop.wait(self.lease_seconds / 3):
+                self.heartbeat(job)
+
+        thread = threading.Thread(target=beat, daemon=True)
+        thread.start()
+        try:
+            yield job
+        finally:
+            stop.set()
+            thread.join()
+
+    def requeue_stale(self) -> int:
+        "Move running jobs whose lease ran out back to pending, returning how many were moved."
+        count = 0
+        now = time.time()
+        for path in (self.root / 'running').glob('*.json'):
+            try:
+                if now - path.stat().st_mtime <= self.lease_seconds:
+                    continue
+                os.rename(str(path), str(self._path('pending', path.stem)))
+            except FileNotFoundError:
+                continue
+            logging.warning('Segment job {0} lost its worker; requeued.'.format(path.stem))
+            count += 1
+        return count
+
+    def complete(self, job: SegmentJob):
+        # Written fresh rather than moved: if the lease ran out meanwhile, the job may be pending again.
+        self._write(self._path('done', job.job_id), job.to_json())
+        self._remove('running', job.job_id)
+        self._remove('pending', job.job_id)
+
+    def fail(self, job: SegmentJob, error: str):
+        record = json.loads(job.to_json())
+        record['error'] = error
+        record['worker'] = socket.gethostname()
+        self._write(self._path('failed', job.job_id), json.dumps(record))
+        self._remove('running', job.job_id)
+
+    def state(self, job_id: str) -> Optional[str]:
+        for state in self.states:
+            if self._path(state, job_id).exists():
+                return state
+        return None
+
+    def finished(self, jobs: List[SegmentJob]) -> bool:
+        "Whether every job in `jobs` is done; raises if one failed.  Also requeues stale jobs."
+        self.requeue_stale()
+        finished = True
+        for job in jobs:
+            state = self.state(job.job_id)
+            if state == 'failed':
+                with open(str(self._path('failed', job.job_id))) as f:
+                    error = json.load(f).get('error')
+                raise RuntimeError('Segment job ' + job.job_id + ' failed: ' + str(error))
+            finished = finished and state == 'done'
+        return finished
+
+    def wait(self, jobs: List[SegmentJob], poll_seconds: float = 2.0, timeout: float = 6 * 3600):
+        "Block until every job in `jobs` is done; raises if one failed or `timeout` seconds pass."
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self.finished(jobs):
+            if deadline is not None and time.monotonic() > deadline:
+                remaining = [job.job_id for job in jobs if self.state(job.job_id) != 'done']
+                raise TimeoutError('Timed out waiting for segment jobs: ' + ', '.join(remaining))
+            time.sleep(poll_seconds)
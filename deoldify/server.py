@@ -0,0 +1,324 @@
+"""HTTP serving entry point: `python -m deoldify.server --models artistic stable --cpu`.
+
+Endpoints:
+
+* `POST /colorize?model=artistic&render_factor=35&post_process=1&watermarked=1` with the
+  image file as the request body; responds with the colorized PNG, streamed in chunks.
+* `GET /metrics`: queue depth, batch-size histogram and latency percentiles as JSON.
+* `GET /health`
+
+Only the standard library is used for the HTTP side, so it runs offline wherever the models load.
+"""
+import argparse
+import json
+import logging
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from pathlib import Path
+from queue import Empty, Full, Queue
+from typing import Dict, List
+from urllib.parse import parse_qs, urlparse
+
+from PIL import Image
+
+from . import device
+from .device_id import DeviceId
+
+
+class ServerMetrics:
+    "Batch-size histogram and a sliding window of request latencies (seconds)."
+
+    def __init__(self, window: int = 10000):
+        self._lock = threading.Lock()
+        self.batch_sizes = Counter()
+        self.latencies = deque(maxlen=window)
+        self.requests = 0
+        self.errors = 0
+
+    def record_batch(self, size: int):
+        with self._lock:
+            self.batch_sizes[size] += 1
+
+    def record_request(self, seconds: float, ok: bool = True):
+        with self._lock:
+            self.requests += 1
+            if not ok:
+                self.errors += 1
+            self.latencies.append(seconds)
+
+    def percentiles(self, qs=(50, 90, 95, 99)) -> Dict[str, float]:
+        with self._lock:
+            latencies = sorted(self.latencies)
+        if not latencies:
+            return {}
+        return {'p' + str(q): latencies[min(len(latencies) - 1, int(q / 100 * len(latencies)))] for q in qs}
+
+    def snapshot(self) -> dict:
+        percentiles = self.percentiles()
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'errors': self.errors,
+                'batch_sizes': {str(size): count for size, count in sorted(self.batch_sizes.items())},
+                'latency_seconds': percentiles,
+            }
+
+
+class _Request:
+    def __init__(self, image: Image.Image, render_factor: int, post_process: bool, watermarked: bool):
+        self.image = image
+        self.params = (render_factor, post_process, watermarked)
+        self.future = Future()
+
+
+class MicroBatcher:
+    """Gathers concurrent requests for one model into batches of up to `max_batch_size`, waiting
+    at most `max_wait` seconds after the first request of a batch for more to arrive.  A single
+    worker thread owns the model, so the filters never run concurrently."""
+
+    def __init__(
+        self,
+        vis,
+        max_batch_size: int = 4,
+        max_wait: float = 0.05,
+        max_queue: int = 64,
+        metrics: ServerMetrics = None,
+    ):
+        self.vis = vis
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait
+        self.metrics = metrics if metrics is not None else ServerMetrics()
+        self._queue = Queue(maxsize=max_queue)
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def submit(
+        self, image: Image.Image, render_factor: int = None, post_process: bool = True, watermarked: bool = True
+    ) -> Future:
+        "Queue `image` for colorization; raises `queue.Full` when the server is saturated."
+        request = _Request(image, render_factor, post_process, watermarked)
+        self._queue.put_nowait(request)
+        return request.future
+
+    def _gather(self) -> List[_Request]:
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._gather()
+            self.metrics.record_batch(len(batch))
+            # Requests with different settings can't share a forward pass.
+            groups = {}
+            for request in batch:
+                groups.setdefault(request.params, []).append(request)
+            for (render_factor, post_process, watermarked), requests in groups.items():
+                try:
+                    results = self.vis.get_transformed_pil_images(
+                        [request.image for request in requests],
+                        render_factor=render_factor,
+                        post_process=post_process,
+                        watermarked=watermarked,
+                    )
+                except Exception as e:
+                    logging.exception('Colorization batch failed')
+                    for request in requests:
+                        request.future.set_exception(e)
+                    continue
+                for request, result in zip(requests, results):
+                    request.future.set_result(result)
+
+
+def load_colorizers(
+    models: List[str],
+    cpu_mode: bool = False,
+    root_folder: Path = Path('./'),
+    fast: bool = True,
+    mmap_weights: bool = False,
+    **batcher_kwargs
+) -> Dict[str, MicroBatcher]:
+    """Load each of `models` ('artistic', 'stable') once and wrap it in its own `MicroBatcher`.
+    `fast` skips the pretrained encoder download and dummy data on start up (see `gen_inference_wide`);
+    `mmap_weights` maps `models/*.flat` so several server processes on a host share the weights."""
+    from .visualize import get_artistic_image_colorizer, get_stable_image_colorizer
+
+    factories = {'artistic': get_artistic_image_colorizer, 'stable': get_stable_image_colorizer}
+    metrics = batcher_kwargs.pop('metrics', None) or ServerMetrics()
+    batchers = {}
+    for name in models:
+        if name not in factories:
+            raise ValueError('Unknown model ' + name + '; expected one of ' + ', '.join(factories))
+        vis = factories[name](root_folder=root_folder, cpu_mode=cpu_mode, fast=fast, mmap_weights=mmap_weights)
+        batchers[name] = MicroBatcher(vis, metrics=metrics, **batcher_kwargs)
+    return batchers
+
+
+def _flag(query: dict, name: str, default: bool) -> bool:
+    values = query.get(name)
+    if not values:
+        return default
+    return values[0].lower() not in ('0', 'false', 'no')
+
+
+class ColorizeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Set on the subclass created by `make_server`.
+    batchers: Dict[str, MicroBatcher] = {}
+    metrics: ServerMetrics = None
+    chunk_size = 64 * 1024
+    timeout_seconds = 300
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+    def _send_json(self, status: int, body: dict):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _stream(self, data: bytes, content_type: str):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for start in range(0, len(data), self.chunk_size):
+            chunk = data[start : start + self.chunk_size]
+            self.wfile.write(('%x\r\n' % len(chunk)).encode('ascii') + chunk + b'\r\n')
+        self.wfile.write(b'0\r\n\r\n')
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == '/health':
+            self._send_json(200, {'status': 'ok', 'models': sorted(self.batchers)})
+        elif path == '/metrics':
+            body = self.metrics.snapshot()
+            body['queue_depth'] = {name: batcher.queue_depth for name, batcher in self.batchers.items()}
+            self._send_json(200, body)
+        else:
+            self._send_json(404, {'error': 'not found'})
+
+    def _read_body(self) -> bytes:
+        # Always consume the whole body, even when rejecting the request: on a keep-alive
+        # connection, unread bytes would be parsed as the next request.
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            self.close_connection = True
+            return b''
+        return self.rfile.read(length)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        body = self._read_body()
+        if url.path != '/colorize':
+            self._send_json(404, {'error': 'not found'})
+            return
+        start = time.monotonic()
+        query = parse_qs(url.query)
+        name = query.get('model', [next(iter(self.batchers))])[0]
+        batcher = self.batchers.get(name)
+        if batcher is None:
+            self._send_json(400, {'error': 'unknown model ' + name})
+            return
+        try:
+            image = Image.open(BytesIO(body)).convert('RGB')
+            render_factor = int(query['render_factor'][0]) if 'render_factor' in query else None
+        except Exception as e:
+            self._send_json(400, {'error': 'bad request: ' + str(e)})
+            return
+
+        try:
+            future = batcher.submit(
+                image,
+                render_factor=render_factor,
+                post_process=_flag(query, 'post_process', True),
+                watermarked=_flag(query, 'watermarked', True),
+            )
+        except Full:
+            self.metrics.record_request(time.monotonic() - start, ok=False)
+            self._send_json(503, {'error': 'server busy'})
+            return
+
+        try:
+            result = future.result(timeout=self.timeout_seconds)
+        except Exception as e:
+            self.metrics.record_request(time.monotonic() - start, ok=False)
+            self._send_json(500, {'error': str(e)})
+            return
+
+        buffer = BytesIO()
+        result.save(buffer, format='PNG')
+        self._stream(buffer.getvalue(), 'image/png')
+        self.metrics.record_request(time.monotonic() - start)
+
+
+def make_server(batchers: Dict[str, MicroBatcher], host: str = '127.0.0.1', port: int = 8000) -> ThreadingHTTPServer:
+    metrics = next(iter(batchers.values())).metrics
+    handler = type('BoundColorizeHandler', (ColorizeHandler,), {'batchers': batchers, 'metrics': metrics})
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Serve DeOldify colorization over HTTP.')
+    parser.add_argument('--models', nargs='+', default=['artistic'], choices=['artistic', 'stable'])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--root-folder', type=Path, default=Path('./'))
+    parser.add_argument('--cpu', action='store_true', help='Run on CPU even if a GPU is available.')
+    parser.add_argument(
+        '--no-fast', dest='fast', action='store_false',
+        help='Build the generators the slow way (pretrained encoder download, dummy data) before loading weights.',
+    )
+    parser.add_argument(
+        '--mmap-weights', action='store_true',
+        help='Memory map models/*.flat weights (see deoldify.flat_weights) so server processes share them.',
+    )
+    parser.add_argument('--max-batch-size', type=int, default=4)
+    parser.add_argument('--max-wait', type=float, default=0.05, help='Seconds to wait for a batch to fill.')
+    parser.add_argument('--max-queue', type=int, default=64)
+    args = parser.parse_args(args)
+
+    # Must happen before torch gets imported by the model loading below.
+    device.set(DeviceId.CPU if args.cpu else DeviceId.GPU0)
+    batchers = load_colorizers(
+        args.models,
+        cpu_mode=args.cpu,
+        fast=args.fast,
+        mmap_weights=args.mmap_weights,
+        root_folder=args.root_folder,
+        max_batch_size=args.max_batch_size,
+        max_wait=args.max_wait,
+        max_queue=args.max_queue,
+    )
+    server = make_server(batchers, host=args.host, port=args.port)
+    logging.info('Serving ' + ', '.join(args.models) + ' on http://' + args.host + ':' + str(args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+import logging
+import multiprocessing
+import os
+import traceback
+from pathlib import Path
+from queue import Empty
+from typing import Callable, List, Sequence, Tuple
+
+from . import device as device_settings
+from .device_id import DeviceId
+
+
+# Nothing in this module may import torch at the top level: spawned workers import it to run
+# `_shard_worker`, and `CUDA_VISIBLE_DEVICES` has to be set before torch is first imported.
+
+
+def _cpu_partitions(count: int) -> List[List[int]]:
+    "Split the CPUs this process may run on into `count` contiguous groups (contiguous ids usually share a socket)."
+    cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count() or 1))
+    size, extra = divmod(len(cpus), count)
+    partitions, start = [], 0
+    for i in range(count):
+        end = start + size + (1 if i < extra else 0)
+        partitions.append(cpus[start:end] or cpus)
+        start = end
+    return partitions
+
+
+def _split_contiguous(jobs: Sequence, count: int) -> List[Sequence]:
+    # Contiguous ranges keep neighbouring frames on the same worker, so chroma reuse and flow
+    # propagation still see consecutive frames, and the split only depends on `count`.
+    size, extra = divmod(len(jobs), count)
+    shards, start = [], 0
+    for i in range(count):
+        end = start + size + (1 if i < extra else 0)
+        shards.append(jobs[start:end])
+        start = end
+    return shards
+
+
+def _shard_worker(
+    index: int,
+    device: DeviceId,
+    cpus: List[int],
+    factory: str,
+    factory_kwargs: dict,
+    jobs: List[Tuple[str, str]],
+    render_factor: int,
+    post_process: bool,
+    watermarked: bool,
+    results,
+):
+    try:
+        device_settings.set(device)
+        if device == DeviceId.CPU and cpus and hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, cpus)
+        import torch
+        from . import visualize
+
+        if device == DeviceId.CPU and cpus:
+            torch.set_num_threads(len(cpus))
+        colorizer = getattr(visualize, factory)(**factory_kwargs)
+        vis = colorizer.vis if isinstance(colorizer, visualize.VideoColorizer) else colorizer
+        for source, dest in jobs:
+            image = vis.get_transformed_image(
+                source, render_factor=render_factor, post_process=post_process, watermarked=watermarked
+            )
+            image.save(dest)
+            results.put(('saved', index, dest))
+        results.put(('done', index, None))
+    except BaseException:
+        results.put(('error', index, traceback.format_exc()))
+
+
+class ShardedFrameColorizer:
+    """Colorizes a frame list across worker processes, one per entry of `devices`.
+
+    Each worker pins itself to its device (a `DeviceId` GPU, or `DeviceId.CPU` with its own slice
+    of the machine's cores), loads its own generator with `visualize.<factory>(**factory_kwargs)`
+    and colorizes a contiguous range of the frames.  Frames are written under their own names, so
+    the output is the same regardless of which worker finishes first.
+    """
+
+    def __init__(self, devices: Sequence[DeviceId], factory: str = 'get_stable_video_colorizer', **factory_kwargs):
+        if len(devices) == 0:
+            raise ValueError('ShardedFrameColorizer needs at least one device.')
+        self.devices = list(devices)
+        self.factory = factory
+        self.factory_kwargs = factory_kwargs
+
+    @property
+    def render_factor(self) -> int:
+        return self.factory_kwargs.get('render_factor')
+
+    def _worker_kwargs(self, device: DeviceId) -> dict:
+        kwargs = dict(self.factory_kwargs)
+        kwargs.setdefault('cpu_mode', device == DeviceId.CPU)
+        return kwargs
+
+    def run(
+        self,
+        jobs: Sequence[Tuple[Path, Path]],
+        render_factor: int = None,
+        post_process: bool = True,
+        watermarked: bool = True,
+        on_saved: Callable[[Path], None] = None,
+    ) -> int:
+        "Colorize every `(source, dest)` pair in `jobs`, returning the number of frames written."
+        jobs = [(str(source), str(dest)) for source, dest in jobs]
+        if len(jobs) == 0:
+            return 0
+        count = min(len(self.devices), len(jobs))
+        devices = self.devices[:count]
+        cpu_workers = sum(1 for d in devices if d == DeviceId.CPU)
+        cpu_partitions = iter(_cpu_partitions(cpu_workers)) if cpu_workers > 0 else iter([])
+
+        # Spawned, not forked: each worker must pick its device before importing torch.
+        context = multiprocessing.get_context('spawn')
+        results = context.Queue()
+        workers = []
+        for index, (device, shard) in enumerate(zip(devices, _split_contiguous(jobs, count))):
+            cpus = next(cpu_partitions) if device == DeviceId.CPU else []
+            worker = context.Process(
+                target=_shard_worker,
+                args=(
+                    index, device, cpus, self.factory, self._worker_kwargs(device), list(shard),
+                    render_factor, post_process, watermarked, results,
+                ),
+                daemon=True,
+            )
+            worker.start()
+            workers.append(worker)
+
+        written = 0
+        running = set(range(count))
+        try:
+            while running:
+                try:
+                    kind, index, payload = results.get(timeout=5)
+                except Empty:
+                    dead = [i for i in running if not workers[i].is_alive()]
+                    if dead:
+                        raise RuntimeError(
+                            'Shard worker {0} exited with code {1}.'.format(dead[0], workers[dead[0]].exitcode)
+                        )
+                    continue
+                if kind == 'saved':
+                    written += 1
+                    if on_saved is not None:
+                        on_saved(Path(payload))
+                elif kind == 'done':
+                    running.discard(index)
+                else:
+                    raise RuntimeError('Shard worker {0} on {1} failed:\n{2}'.format(index, devices[index], payload))
+        finally:
+            for worker in workers:
+                if worker.is_alive() and running:
+                    worker.terminate()
+                worker.join()
+        logging.info('Colorized {0} frames across {1} workers.'.format(written, count))
+        return written
@@ -7,7 +7,7 @@ from fastai.vision import *
 
 # The code below is meant to be merged into fastaiv1 ideally
 
-__all__ = ['DynamicUnetDeep', 'DynamicUnetWide']
+__all__ = ['DynamicUnetDeep', 'DynamicUnetWide', 'ExplicitSkipUnet']
 
 
 def _get_sfs_idxs(sizes: Sizes) -> List[int]:
@@ -82,7 +82,9 @@ class UnetBlockDeep(nn.Module):
         self.relu = relu(leaky=leaky)
 
     def forward(self, up_in: Tensor) -> Tensor:
-        s = self.hook.stored
+        return self.forward_skip(up_in, self.hook.stored)
+
+    def forward_skip(self, up_in: Tensor, s: Tensor) -> Tensor:
         up_out = self.shuf(up_in)
         ssh = s.shape[-2:]
         if ssh != up_out.shape[-2:]:
@@ -106,14 +108,17 @@ class DynamicUnetDeep(SequentialEx):
         bottle: bool = False,
         norm_type: Optional[NormType] = NormType.Batch,
         nf_factor: float = 1.0,
+        sfs_szs: Sizes = None,
         **kwargs
     ):
         extra_bn = norm_type == NormType.Spectral
         imsize = (256, 256)
-        sfs_szs = model_sizes(encoder, size=imsize)
+        # `sfs_szs` are the encoder's activation sizes at `imsize`; passing them in skips the dummy forward pass.
+        if sfs_szs is None:
+            sfs_szs = model_sizes(encoder, size=imsize)
         sfs_idxs = list(reversed(_get_sfs_idxs(sfs_szs)))
+        self.sfs_idxs = sfs_idxs
         self.sfs = hook_outputs([encoder[i] for i in sfs_idxs], detach=False)
-        x = dummy_eval(encoder, imsize).detach()
 
         ni = sfs_szs[-1][1]
         middle_conv = nn.Sequential(
@@ -124,12 +129,12 @@ class DynamicUnetDeep(SequentialEx):
                 ni * 2, ni, norm_type=norm_type, extra_bn=extra_bn, **kwargs
             ),
         ).eval()
-        x = middle_conv(x)
+        up_in_c = ni
         layers = [encoder, batchnorm_2d(ni), nn.ReLU(), middle_conv]
 
         for i, idx in enumerate(sfs_idxs):
             not_final = i != len(sfs_idxs) - 1
-            up_in_c, x_in_c = int(x.shape[1]), int(sfs_szs[idx][1])
+            x_in_c = int(sfs_szs[idx][1])
             do_blur = blur and (not_final or blur_final)
             sa = self_attention and (i == len(sfs_idxs) - 3)
             unet_block = UnetBlockDeep(
@@ -145,9 +150,9 @@ class DynamicUnetDeep(SequentialEx):
                 **kwargs
             ).eval()
             layers.append(unet_block)
-            x = unet_block(x)
+            up_in_c = unet_block.conv2[0].out_channels
 
-        ni = x.shape[1]
+        ni = up_in_c
         if imsize != sfs_szs[0][-2:]:
             layers.append(PixelShuffle_ICNR(ni, **kwargs))
         if last_cross:
@@ -196,7 +201,9 @@ class UnetBlockWide(nn.Module):
         self.relu = relu(leaky=leaky)
 
     def forward(self, up_in: Tensor) -> Tensor:
-        s = self.hook.stored
+        return self.forward_skip(up_in, self.hook.stored)
+
+    def forward_skip(self, up_in: Tensor, s: Tensor) -> Tensor:
         up_out = self.shuf(up_in)
         ssh = s.shape[-2:]
         if ssh != up_out.shape[-2:]:
@@ -220,16 +227,19 @@ class DynamicUnetWide(SequentialEx):
         bottle: bool = False,
         norm_type: Optional[NormType] = NormType.Batch,
         nf_factor: int = 1,
+        sfs_szs: Sizes = None,
         **kwargs
     ):
 
         nf = 512 * nf_factor
         extra_bn = norm_type == NormType.Spectral
         imsize = (256, 256)
-        sfs_szs = model_sizes(encoder, size=imsize)
+        # `sfs_szs` are the encoder's activation sizes at `imsize`; passing them in skips the dummy forward pass.
+        if sfs_szs is None:
+            sfs_szs = model_sizes(encoder, size=imsize)
         sfs_idxs = list(reversed(_get_sfs_idxs(sfs_szs)))
+        self.sfs_idxs = sfs_idxs
         self.sfs = hook_outputs([encoder[i] for i in sfs_idxs], detach=False)
-        x = dummy_eval(encoder, imsize).detach()
 
         ni = sfs_szs[-1][1]
         middle_conv = nn.Sequential(
@@ -240,12 +250,12 @@ class DynamicUnetWide(SequentialEx):
                 ni * 2, ni, norm_type=norm_type, extra_bn=extra_bn, **kwargs
             ),
         ).eval()
-        x = middle_conv(x)
+        up_in_c = ni
         layers = [encoder, batchnorm_2d(ni), nn.ReLU(), middle_conv]
 
         for i, idx in enumerate(sfs_idxs):
             not_final = i != len(sfs_idxs) - 1
-            up_in_c, x_in_c = int(x.shape[1]), int(sfs_szs[idx][1])
+            x_in_c = int(sfs_szs[idx][1])
             do_blur = blur and (not_final or blur_final)
             sa = self_attention and (i == len(sfs_idxs) - 3)
 
@@ -264,9 +274,9 @@ class DynamicUnetWide(SequentialEx):
                 **kwargs
             ).eval()
             layers.append(unet_block)
-            x = unet_block(x)
+            up_in_c = unet_block.conv[0].out_channels
 
-        ni = x.shape[1]
+        ni = up_in_c
         if imsize != sfs_szs[0][-2:]:
             layers.append(PixelShuffle_ICNR(ni, **kwargs))
         if last_cross:
@@ -283,3 +293,43 @@ class DynamicUnetWide(SequentialEx):
     def __del__(self):
         if hasattr(self, "sfs"):
             self.sfs.remove()
+
+
+# ------------------------------------------------------
+def _without_forward_hooks(module: nn.Module) -> nn.Module:
+    view = copy(module)
+    view._forward_hooks = OrderedDict()
+    return view
+
+
+class ExplicitSkipUnet(nn.Module):
+    "Hook-free view of a `DynamicUnetWide`/`DynamicUnetDeep` passing skip connections explicitly, so it can be traced/exported."
+
+    def __init__(self, unet: SequentialEx):
+        super().__init__()
+        # The encoder layers are shallow copies without the `sfs` forward hooks, so running this view
+        # never writes `Hook.stored` on hooks shared with `unet`; weights and submodules are still
+        # shared (not duplicated), and `unet` keeps working as before.
+        self.encoder = nn.Sequential(*[_without_forward_hooks(layer) for layer in unet.layers[0]])
+        self.layers = nn.ModuleList(unet.layers[1:])
+        self.sfs_idxs = list(unet.sfs_idxs)
+
+    def forward(self, x: Tensor) -> Tensor:
+        inp = x
+        stored = {}
+        for i, layer in enumerate(self.encoder):
+            x = layer(x)
+            if i in self.sfs_idxs:
+                stored[i] = x
+        skips = [stored[i] for i in self.sfs_idxs]
+
+        n_block = 0
+        for layer in self.layers:
+            if isinstance(layer, (UnetBlockDeep, UnetBlockWide)):
+                x = layer.forward_skip(x, skips[n_block])
+                n_block += 1
+            elif isinstance(layer, MergeLayer):
+                x = torch.cat([x, inp], dim=1) if layer.dense else x + inp
+            else:
+                x = layer(x)
+        return x
@@ -1,61 +1,98 @@
 from fastai.core import *
 from fastai.vision import *
-from matplotlib.axes import Axes
-from .filters import IFilter, MasterFilter, ColorizerFilter
+from .filters import IFilter, MasterFilter, ColorizerFilter, ChromaReuseFilter, FlowPropagationFilter, check_color_deviation
 from .generators import gen_inference_deep, gen_inference_wide
+from .optimize import optimize_for_inference, quantize_convs
+from .pipeline import FramePipeline
+from .manifest import FrameManifest, file_hash
+from .planner import RenderPlan, RenderPlanner
+from ._lazy import LazyModule
+from .watermark import WatermarkCompositor
+from .cache import ResultCache, result_cache_key
+from .instrument import stage
+from .sharding import ShardedFrameColorizer
+from .device_id import DeviceId
+from .segments import FileJobQueue, SegmentJob
 from PIL import Image
-import ffmpeg
-import yt_dlp as youtube_dl
 import gc
+import copy
+import time
 import requests
 from io import BytesIO
 import base64
-from IPython import display as ipythondisplay
-from IPython.display import HTML
-from IPython.display import Image as ipythonimage
-import cv2
+
+# Only needed for video, youtube downloads and notebook display, so they're imported on first use
+# to keep headless image workers quick to start.
+ffmpeg = LazyModule('ffmpeg')
+youtube_dl = LazyModule('yt_dlp')
+ipythondisplay = LazyModule('IPython.display')
 import logging
 
-# adapted from https://www.pyimagesearch.com/2016/04/25/watermarking-images-with-opencv-and-python/
+_watermark_compositor = WatermarkCompositor()
+
+
 def get_watermarked(pil_image: Image) -> Image:
     try:
-        image = cv2.cvtColor(np.array(pil_image), cv2.COLOR_RGB2BGR)
-        (h, w) = image.shape[:2]
-        image = np.dstack([image, np.ones((h, w), dtype="uint8") * 255])
-        pct = 0.05
-        full_watermark = cv2.imread(
-            './resource_images/watermark.png', cv2.IMREAD_UNCHANGED
-        )
-        (fwH, fwW) = full_watermark.shape[:2]
-        wH = int(pct * h)
-        wW = int((pct * h / fwH) * fwW)
-        watermark = cv2.resize(full_watermark, (wH, wW), interpolation=cv2.INTER_AREA)
-        overlay = np.zeros((h, w, 4), dtype="uint8")
-        (wH, wW) = watermark.shape[:2]
-        overlay[h - wH - 10 : h - 10, 10 : 10 + wW] = watermark
-        # blend the two images together using transparent overlays
-        output = image.copy()
-        cv2.addWeighted(overlay, 0.5, output, 1.0, 0, output)
-        rgb_image = cv2.cvtColor(output, cv2.COLOR_BGR2RGB)
-        final_image = Image.fromarray(rgb_image)
-        return final_image
+        with stage('watermark'):
+            return _watermark_compositor.apply(pil_image)
     except:
         # Don't want this to crash everything, so let's just not watermark the image for now.
         return pil_image
 
 
+def get_watermarked_array(image: np.ndarray, in_place: bool = False) -> np.ndarray:
+    try:
+        with stage('watermark'):
+            return _watermark_compositor.apply_array(image, in_place=in_place)
+    except:
+        return image
+
+
 class ModelImageVisualizer:
-    def __init__(self, filter: IFilter, results_dir: str = None):
+    def __init__(
+        self,
+        filter: IFilter,
+        results_dir: str = None,
+        planner: RenderPlanner = None,
+        cache: ResultCache = None,
+        weights_name: str = None,
+    ):
         self.filter = filter
+        self.planner = planner
+        self.cache = cache
+        self.weights_name = weights_name
         self.results_dir = None if results_dir is None else Path(results_dir)
         self.results_dir.mkdir(parents=True, exist_ok=True)
 
+    def plan_render(self, render_factor: int = None, batch_size: int = 1) -> RenderPlan:
+        "What `render_factor` would actually be used for a batch of `batch_size`, and whether it fits in memory."
+        render_factor = ifnone(render_factor, getattr(self.filter, 'render_factor', None))
+        if self.planner is None:
+            return RenderPlan(render_factor, batch_size, 0, 0)
+        return self.planner.plan(render_factor, batch_size=batch_size)
+
+    def _get_render_factor(self, render_factor: int, batch_size: int) -> int:
+        # Downsize up front rather than letting the forward pass run out of memory.
+        if self.planner is None:
+            return render_factor
+        plan = self.plan_render(render_factor, batch_size)
+        if not plan.feasible:
+            logging.warning(
+                'Estimated {0} bytes for render_factor {1} exceeds the {2} byte budget.'.format(
+                    plan.estimated_bytes, plan.render_factor, plan.budget_bytes
+                )
+            )
+        elif plan.render_factor != ifnone(render_factor, plan.render_factor):
+            logging.info('Downsizing render_factor from {0} to {1} to fit in memory.'.format(render_factor, plan.render_factor))
+        return plan.render_factor
+
     def _clean_mem(self):
         torch.cuda.empty_cache()
         # gc.collect()
 
     def _open_pil_image(self, path: Path) -> Image:
-        return PIL.Image.open(path).convert('RGB')
+        with stage('open_image'):
+            return PIL.Image.open(path).convert('RGB')
 
     def _get_image_from_url(self, url: str) -> Image:
         response = requests.get(url, timeout=30, headers={'user-agent':'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/62.0.3202.94 Safari/537.36'})
@@ -162,15 +199,48 @@ class ModelImageVisualizer:
         if results_dir is None:
             results_dir = Path(self.results_dir)
         result_path = results_dir / source_path.name
-        image.save(result_path)
+        with stage('save'):
+            image.save(result_path)
         return result_path
 
     def get_transformed_image(
         self, path: Path, render_factor: int = None, post_process: bool = True,
         watermarked: bool = True,
     ) -> Image:
-        self._clean_mem()
+        if self.cache is None:
+            orig_image = self._open_pil_image(path)
+            return self.get_transformed_pil_image(
+                orig_image, render_factor, post_process=post_process, watermarked=watermarked
+            )
+
+        # Key on the render factor actually used, so a planner downsizing still hits the cache.
+        render_factor = self._get_render_factor(
+            ifnone(render_factor, getattr(self.filter, 'render_factor', None)), 1
+        )
+        key = result_cache_key(
+            file_hash(path), render_factor, self.weights_name, post_process, watermarked
+        )
+        result = self.cache.get(key)
+        if result is not None:
+            return result
         orig_image = self._open_pil_image(path)
+        result = self._transform_pil_image(orig_image, render_factor, post_process, watermarked)
+        self.cache.put(key, result)
+        return result
+
+    def get_transformed_pil_image(
+        self, orig_image: Image, render_factor: int = None, post_process: bool = True,
+        watermarked: bool = True,
+    ) -> Image:
+        return self._transform_pil_image(
+            orig_image, self._get_render_factor(render_factor, 1), post_process, watermarked
+        )
+
+    def _transform_pil_image(
+        self, orig_image: Image, render_factor: int, post_process: bool, watermarked: bool
+    ) -> Image:
+        # `render_factor` has already been through `_get_render_factor`.
+        self._clean_mem()
         filtered_image = self.filter.filter(
             orig_image, orig_image, render_factor=render_factor,post_process=post_process
         )
@@ -180,11 +250,57 @@ class ModelImageVisualizer:
 
         return filtered_image
 
+    def get_transformed_images(
+        self, paths: List[Path], render_factor: int = None, post_process: bool = True,
+        watermarked: bool = True, batch_size: int = 4,
+    ) -> List[Image]:
+        results = []
+        for i in range(0, len(paths), batch_size):
+            orig_images = [self._open_pil_image(path) for path in paths[i : i + batch_size]]
+            results.extend(
+                self.get_transformed_pil_images(
+                    orig_images, render_factor, post_process=post_process, watermarked=watermarked
+                )
+            )
+
+        return results
+
+    def get_transformed_pil_images(
+        self, orig_images: List[Image], render_factor: int = None, post_process: bool = True,
+        watermarked: bool = True,
+    ) -> List[Image]:
+        self._clean_mem()
+        render_factor = self._get_render_factor(render_factor, len(orig_images))
+        filtered_images = self.filter.filter_batch(
+            orig_images, orig_images, render_factor=render_factor, post_process=post_process
+        )
+
+        if watermarked:
+            return [get_watermarked(image) for image in filtered_images]
+
+        return filtered_images
+
+    def get_transformed_arrays(
+        self, orig_arrays: List[np.ndarray], render_factor: int = None, post_process: bool = True,
+        watermarked: bool = True,
+    ) -> List[np.ndarray]:
+        "Colorize RGB uint8 HxWx3 arrays in one batch, keeping them as arrays end to end."
+        self._clean_mem()
+        render_factor = self._get_render_factor(render_factor, len(orig_arrays))
+        results = self.filter.filter_arrays(
+            orig_arrays, orig_arrays, render_factor=render_factor, post_process=post_process
+        )
+
+        if watermarked:
+            return [get_watermarked_array(result, in_place=True) for result in results]
+
+        return results
+
     def _plot_image(
         self,
         image: Image,
         render_factor: int,
-        axes: Axes = None,
+        axes: 'matplotlib.axes.Axes' = None,
         figsize=(20, 20),
         display_render_factor = False,
     ):
@@ -209,20 +325,54 @@ class ModelImageVisualizer:
 
 
 class VideoColorizer:
-    def __init__(self, vis: ModelImageVisualizer):
+    def __init__(
+        self,
+        vis: ModelImageVisualizer,
+        pipeline: FramePipeline = None,
+        weights_name: str = None,
+        shards: ShardedFrameColorizer = None,
+    ):
+        # With `shards`, frames are colorized by worker processes with their own models and `vis` may be None.
         self.vis = vis
+        self.pipeline = pipeline
+        self.weights_name = weights_name
+        self.shards = shards
         workfolder = Path('./video')
         self.source_folder = workfolder / "source"
         self.bwframes_root = workfolder / "bwframes"
         self.audio_root = workfolder / "audio"
         self.colorframes_root = workfolder / "colorframes"
         self.result_folder = workfolder / "result"
+        self.manifest_root = workfolder / "manifests"
+        self.segments_root = workfolder / "segments"
+        self.queue_root = workfolder / "queue"
 
     def _purge_images(self, dir):
         for f in os.listdir(dir):
             if re.search('.*?\.jpg', f):
                 os.remove(os.path.join(dir, f))
 
+    def _list_images(self, dir) -> List[str]:
+        return sorted(f for f in os.listdir(dir) if re.search('.*?\.jpg', f))
+
+    def _get_manifest(self, source_path: Path) -> FrameManifest:
+        return FrameManifest(self.manifest_root / (source_path.stem + '.json'), file_hash(source_path))
+
+    def _get_colorize_key(self, render_factor: int, post_process: bool, watermarked: bool) -> dict:
+        if render_factor is None:
+            render_factor = self._get_default_render_factor()
+        return {
+            'render_factor': render_factor,
+            'weights_name': self.weights_name,
+            'post_process': post_process,
+            'watermarked': watermarked,
+        }
+
+    def _get_default_render_factor(self) -> int:
+        if self.shards is not None:
+            return self.shards.render_factor
+        return getattr(self.vis.filter, 'render_factor', None)
+
     def _get_ffmpeg_probe(self, path:Path):
         try:
             probe = ffmpeg.probe(str(path))
@@ -244,6 +394,14 @@ class VideoColorizer:
         )
         return stream_data['avg_frame_rate']
 
+    def _get_frame_size(self, source_path: Path) -> Tuple[int, int]:
+        probe = self._get_ffmpeg_probe(source_path)
+        stream_data = next(
+            (stream for stream in probe['streams'] if stream['codec_type'] == 'video'),
+            None,
+        )
+        return int(stream_data['width']), int(stream_data['height'])
+
     def _download_video_from_url(self, source_url, source_path: Path):
         if source_path.exists():
             source_path.unlink()
@@ -257,10 +415,13 @@ class VideoColorizer:
         with youtube_dl.YoutubeDL(ydl_opts) as ydl:
             ydl.download([source_url])
 
-    def _extract_raw_frames(self, source_path: Path):
+    def _extract_raw_frames(self, source_path: Path, manifest: FrameManifest = None):
         bwframes_folder = self.bwframes_root / (source_path.stem)
         bwframe_path_template = str(bwframes_folder / '%5d.jpg')
         bwframes_folder.mkdir(parents=True, exist_ok=True)
+        if manifest is not None and manifest.is_extracted(len(self._list_images(bwframes_folder))):
+            logging.info('Reusing previously extracted frames for ' + str(source_path))
+            return
         self._purge_images(bwframes_folder)
 
         process = (
@@ -283,90 +444,399 @@ class VideoColorizer:
             logging.error('Errror while extracting raw frames from source video.  Details: {0}'.format(e), exc_info=True)   
             raise e
 
+        if manifest is not None:
+            manifest.mark_extracted(len(self._list_images(bwframes_folder)))
+
     def _colorize_raw_frames(
         self, source_path: Path, render_factor: int = None, post_process: bool = True,
-        watermarked: bool = True,
-    ):
+        watermarked: bool = True, manifest: FrameManifest = None,
+    ) -> int:
+        "Colorize the extracted frames of `source_path`, returning how many went through the model this run."
         colorframes_folder = self.colorframes_root / (source_path.stem)
         colorframes_folder.mkdir(parents=True, exist_ok=True)
-        self._purge_images(colorframes_folder)
         bwframes_folder = self.bwframes_root / (source_path.stem)
 
-        for img in progress_bar(os.listdir(str(bwframes_folder))):
-            img_path = bwframes_folder / img
+        if manifest is None:
+            self._purge_images(colorframes_folder)
+            # In frame order: the chroma reuse filters compare each frame with the previous ones.
+            pending = self._list_images(bwframes_folder)
+            on_saved = None
+        else:
+            done = manifest.colorized_frames(
+                self._get_colorize_key(render_factor, post_process, watermarked)
+            )
+            if not done:
+                self._purge_images(colorframes_folder)
+            # A frame only counts as done if the manifest lists it and its output is still on disk.
+            pending = [
+                img for img in self._list_images(bwframes_folder)
+                if img not in done or not self._is_valid_frame(colorframes_folder / img)
+            ]
+            on_saved = lambda dest: manifest.mark_colorized(dest.name)
+            if len(pending) == 0:
+                logging.info('All frames already colorized for ' + str(source_path))
+                return 0
+
+        self._reset_chroma_reuse()
+        try:
+            if self.shards is not None:
+                jobs = [(bwframes_folder / img, colorframes_folder / img) for img in pending]
+                self.shards.run(
+                    jobs, render_factor=render_factor, post_process=post_process,
+                    watermarked=watermarked, on_saved=on_saved,
+                )
+                return len(pending)
 
-            if os.path.isfile(str(img_path)):
+            if self.pipeline is not None:
+                jobs = ((bwframes_folder / img, colorframes_folder / img) for img in pending)
+                self.pipeline.run(
+                    self.vis, jobs, render_factor=render_factor, post_process=post_process,
+                    finish=get_watermarked if watermarked else None, on_saved=on_saved,
+                )
+                return len(pending)
+
+            for img in progress_bar(pending):
+                img_path = bwframes_folder / img
                 color_image = self.vis.get_transformed_image(
                     str(img_path), render_factor=render_factor, post_process=post_process,watermarked=watermarked
                 )
                 color_image.save(str(colorframes_folder / img))
+                if on_saved is not None:
+                    on_saved(colorframes_folder / img)
+            return len(pending)
+        finally:
+            if manifest is not None:
+                manifest.save()
+            self._report_chroma_reuse(source_path)
+
+    def _get_chroma_reuse_filters(self) -> List[ChromaReuseFilter]:
+        if self.vis is None:
+            return []
+        filters = getattr(self.vis.filter, 'filters', [self.vis.filter])
+        return [f for f in filters if isinstance(f, ChromaReuseFilter)]
+
+    def _reset_chroma_reuse(self):
+        for f in self._get_chroma_reuse_filters():
+            f.reset()
+
+    def _report_chroma_reuse(self, source_path: Path):
+        for f in self._get_chroma_reuse_filters():
+            logging.info(
+                'Reused chroma for {0} of {1} frames ({2:.1%}) of {3} at threshold {4}'.format(
+                    f.skipped, f.frames, f.skip_ratio, source_path, f.threshold
+                )
+            )
+
+    def _is_valid_frame(self, path: Path) -> bool:
+        return path.is_file() and path.stat().st_size > 0
 
     def _build_video(self, source_path: Path) -> Path:
-        colorized_path = self.result_folder / (
-            source_path.name.replace('.mp4', '_no_audio.mp4')
+        # Frames, plus the original audio when there is some, go into the final file in one ffmpeg pass.
+        result_path = self.result_folder / source_path.name
+        self._write_video(
+            self._get_frames_input(source_path), source_path, result_path,
+            'building output video', crf=17, vcodec='libx264',
         )
+        logging.info('Video created here: ' + str(result_path))
+        return result_path
+
+    def _get_frames_input(self, source_path: Path):
         colorframes_folder = self.colorframes_root / (source_path.stem)
         colorframes_path_template = str(colorframes_folder / '%5d.jpg')
-        colorized_path.parent.mkdir(parents=True, exist_ok=True)
-        if colorized_path.exists():
-            colorized_path.unlink()
         fps = self._get_fps(source_path)
+        return ffmpeg.input(str(colorframes_path_template), format='image2', vcodec='mjpeg', framerate=fps)
 
-        process = (
-            ffmpeg 
-                .input(str(colorframes_path_template), format='image2', vcodec='mjpeg', framerate=fps) 
-                .output(str(colorized_path), crf=17, vcodec='libx264')
-                .global_args('-hide_banner')
-                .global_args('-nostats')
-                .global_args('-loglevel', 'error')
+    def _encode_frames(self, source_path: Path, colorized_path: Path):
+        "Encode the colorized frames of `source_path` to `colorized_path`, without audio."
+        self._write_video(
+            self._get_frames_input(source_path), None, colorized_path,
+            'building output video', crf=17, vcodec='libx264',
         )
 
+    def _get_audio_stream(self, source_path: Path) -> Optional[dict]:
+        probe = self._get_ffmpeg_probe(source_path)
+        return next(
+            (stream for stream in probe['streams'] if stream['codec_type'] == 'audio'),
+            None,
+        )
+
+    # Codecs the mp4 muxer takes as-is; anything else gets re-encoded to AAC.
+    _copyable_audio_codecs = ('aac', 'mp3', 'ac3', 'eac3', 'alac')
+
+    def _write_video(
+        self, video, audio_source: Optional[Path], output_path: Path, description: str, **video_args
+    ):
+        """Write the `video` stream to `output_path`, muxing in the first audio stream of `audio_source`
+        (if given and it has one) in the same pass.  Audio is stream copied when mp4 can hold it."""
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        audio_stream = None if audio_source is None else self._get_audio_stream(audio_source)
+        if audio_stream is None:
+            streams, audio_args = [video], {}
+        else:
+            streams = [video, ffmpeg.input(str(audio_source))['a:0']]
+            if audio_stream.get('codec_name') in self._copyable_audio_codecs:
+                audio_args = {'acodec': 'copy'}
+            else:
+                audio_args = {'acodec': 'aac', 'audio_bitrate': '256k'}
+            audio_args['shortest'] = None
+
+        def output(args: dict):
+            return (
+                ffmpeg
+                    .output(*streams, str(output_path), **video_args, **args)
+                    .global_args('-hide_banner')
+                    .global_args('-nostats')
+                    .global_args('-loglevel', 'error')
+                    .overwrite_output()
+            )
+
+        if audio_args.get('acodec') == 'copy':
+            try:
+                output(audio_args).run(capture_stdout=True, capture_stderr=True)
+                return
+            except ffmpeg.Error as e:
+                logging.warning(
+                    'Copying the {0} audio of {1} failed, re-encoding it to AAC instead: {2}'.format(
+                        audio_stream.get('codec_name'), audio_source, e.stderr.decode('UTF-8', 'replace')
+                    )
+                )
+                audio_args.update(acodec='aac', audio_bitrate='256k')
+        self._run_ffmpeg(output(audio_args), description)
+
+    def _run_ffmpeg(self, process, description: str):
         try:
-            process.run()
+            process.run(capture_stdout=True, capture_stderr=True)
         except ffmpeg.Error as e:
             logging.error("ffmpeg error: {0}".format(e), exc_info=True)
             logging.error('stdout:' + e.stdout.decode('UTF-8'))
             logging.error('stderr:' + e.stderr.decode('UTF-8'))
             raise e
         except Exception as e:
-            logging.error('Errror while building output video.  Details: {0}'.format(e), exc_info=True)   
+            logging.error('Errror while {0}.  Details: {1}'.format(description, e), exc_info=True)
             raise e
 
+    def _split_segments(self, source_path: Path, segment_seconds: float) -> List[Path]:
+        "Cut the video stream of `source_path` into roughly `segment_seconds` long pieces at keyframes, without re-encoding."
+        segments_folder = self.segments_root / source_path.stem / 'source'
+        segments_folder.mkdir(parents=True, exist_ok=True)
+        for f in segments_folder.glob('*.mp4'):
+            f.unlink()
+        segment_template = str(segments_folder / (source_path.stem + '_seg%05d.mp4'))
+        process = (
+            ffmpeg
+                .input(str(source_path))
+                .output(
+                    segment_template, format='segment', segment_time=segment_seconds,
+                    reset_timestamps=1, map='0:v:0', vcodec='copy',
+                )
+                .global_args('-hide_banner')
+                .global_args('-nostats')
+                .global_args('-loglevel', 'error')
+        )
+        self._run_ffmpeg(process, 'splitting source video into segments')
+        return sorted(segments_folder.glob('*.mp4'))
+
+    def split_into_segment_jobs(
+        self, file_name: str, segment_seconds: float = 60, render_factor: int = None,
+        post_process: bool = True, watermarked: bool = True,
+    ) -> List[SegmentJob]:
+        """Split `source_folder/file_name` at keyframes into segments that can each be colorized as
+        an independent `SegmentJob`, by this or any other worker sharing the video folder."""
+        source_path = self.source_folder / file_name
+        output_folder = self.segments_root / source_path.stem / 'color'
+        output_folder.mkdir(parents=True, exist_ok=True)
+        return [
+            SegmentJob(
+                job_id=segment.stem,
+                parent=str(source_path.resolve()),
+                index=index,
+                source=str(segment.resolve()),
+                output=str((output_folder / segment.name).resolve()),
+                render_factor=ifnone(render_factor, self._get_default_render_factor()),
+                post_process=post_process,
+                watermarked=watermarked,
+                weights_name=self.weights_name,
+            )
+            for index, segment in enumerate(self._split_segments(source_path, segment_seconds))
+        ]
+
+    def colorize_segment(self, job: SegmentJob) -> Path:
+        "Colorize one segment into `job.output` (video only; audio is added back once the segments are joined)."
+        if not self._can_colorize_segment(job):
+            raise ValueError(
+                'Segment job {0} needs {1} but this worker runs {2}.'.format(job.job_id, job.weights_name, self.weights_name)
+            )
+        segment_path = Path(job.source)
+        self._extract_raw_frames(segment_path)
+        self._colorize_raw_frames(
+            segment_path, render_factor=job.render_factor, post_process=job.post_process,
+            watermarked=job.watermarked,
+        )
+        output_path = Path(job.output)
+        self._encode_frames(segment_path, output_path)
+        return output_path
+
+    def _can_colorize_segment(self, job: SegmentJob) -> bool:
+        # Mixing models within one video would show as color jumps at segment boundaries.
+        return job.weights_name is None or job.weights_name == self.weights_name
+
+    def run_segment_worker(self, queue: FileJobQueue = None) -> int:
+        """Colorize segment jobs from `queue` until it has none pending that this worker's model can
+        do, returning how many were done.  Jobs for other weights are left for other workers."""
+        queue = ifnone(queue, FileJobQueue(self.queue_root))
+        count = 0
+        skipped = set()
+        job = queue.claim()
+        while job is not None:
+            if not self._can_colorize_segment(job):
+                logging.info('Leaving segment job {0} ({1}) for another worker.'.format(job.job_id, job.weights_name))
+                queue.release(job)
+                skipped.add(job.job_id)
+            else:
+                try:
+                    with queue.lease(job):
+                        self.colorize_segment(job)
+                except Exception as e:
+                    logging.error('Segment job {0} failed.'.format(job.job_id), exc_info=True)
+                    queue.fail(job, str(e))
+                else:
+                    queue.complete(job)
+                    count += 1
+            job = queue.claim(exclude=skipped)
+        return count
+
+    def join_segments(self, jobs: List[SegmentJob]) -> Path:
+        "Stitch the colorized segments of one video back together with the concat demuxer, then add the audio back."
+        jobs = sorted(jobs, key=lambda job: job.index)
+        source_path = Path(jobs[0].parent)
         result_path = self.result_folder / source_path.name
-        if result_path.exists():
-            result_path.unlink()
-        # making copy of non-audio version in case adding back audio doesn't apply or fails.
-        shutil.copyfile(str(colorized_path), str(result_path))
-
-        # adding back sound here
-        audio_file = Path(str(source_path).replace('.mp4', '.aac'))
-        if audio_file.exists():
-            audio_file.unlink()
-
-        os.system(
-            'ffmpeg -y -i "'
-            + str(source_path)
-            + '" -vn -acodec copy "'
-            + str(audio_file)
-            + '"'
-            + ' -hide_banner'
-            + ' -nostats'
-            + ' -loglevel error'
+        list_path = self.segments_root / source_path.stem / 'concat.txt'
+        with open(str(list_path), 'w') as f:
+            for job in jobs:
+                f.write("file '" + job.output.replace("'", "'\\''") + "'\n")
+
+        self._write_video(
+            ffmpeg.input(str(list_path), format='concat', safe=0).video, source_path, result_path,
+            'joining colorized segments', vcodec='copy',
+        )
+        logging.info('Video created here: ' + str(result_path))
+        return result_path
+
+    def colorize_segmented(
+        self, file_name: str, segment_seconds: float = 60, render_factor: int = None,
+        post_process: bool = True, watermarked: bool = True, queue: FileJobQueue = None,
+        timeout: float = 6 * 3600, poll_seconds: float = 2.0,
+    ) -> Path:
+        """Colorize `source_folder/file_name` as independent keyframe-aligned segments.  The jobs go
+        through `queue` (by default a directory under the video folder); this process works on them
+        too, and any other worker running `run_segment_worker` on the same queue can help.  Jobs
+        whose worker dies are requeued once their lease runs out and picked up again here."""
+        queue = ifnone(queue, FileJobQueue(self.queue_root))
+        jobs = self.split_into_segment_jobs(
+            file_name, segment_seconds, render_factor=render_factor, post_process=post_process,
+            watermarked=watermarked,
+        )
+        if len(jobs) == 0:
+            raise Exception('No segments were produced from ' + file_name + '.')
+        for job in jobs:
+            queue.put(job)
+        deadline = time.monotonic() + timeout
+        while not queue.finished(jobs):
+            if self.run_segment_worker(queue) > 0:
+                continue
+            if time.monotonic() > deadline:
+                raise TimeoutError('Timed out after {0}s waiting for the segments of {1}.'.format(timeout, file_name))
+            time.sleep(poll_seconds)
+        return self.join_segments(jobs)
+
+    def _colorize_streaming(
+        self, source_path: Path, render_factor: int = None, post_process: bool = True,
+        watermarked: bool = True, batch_size: int = 1,
+    ) -> Path:
+        # Frames are decoded as rawvideo from one ffmpeg process's stdout, colorized a batch at a time
+        # and written as rawvideo into a second ffmpeg (libx264) process's stdin.  Nothing touches disk
+        # until the encoded video, and memory is bounded by `batch_size` frames plus the pipe buffers.
+        # The encoder muxes in the source's audio itself, so the result is written in a single pass.
+        result_path = self.result_folder / source_path.name
+        result_path.parent.mkdir(parents=True, exist_ok=True)
+        fps = self._get_fps(source_path)
+        width, height = self._get_frame_size(source_path)
+        frame_bytes = width * height * 3
+
+        streams = [
+            ffmpeg.input('pipe:', format='rawvideo', pix_fmt='rgb24', s='{}x{}'.format(width, height), framerate=fps)
+        ]
+        audio_args = {}
+        audio_stream = self._get_audio_stream(source_path)
+        if audio_stream is not None:
+            # No second attempt is possible once frames are streaming, so only copy AAC, which mp4 always takes.
+            streams.append(ffmpeg.input(str(source_path))['a:0'])
+            audio_args = {'acodec': 'copy'} if audio_stream.get('codec_name') == 'aac' else {'acodec': 'aac', 'audio_bitrate': '256k'}
+            audio_args['shortest'] = None
+        encoder = (
+            ffmpeg
+                .output(*streams, str(result_path), crf=17, vcodec='libx264', pix_fmt='yuv420p', **audio_args)
+                .global_args('-hide_banner')
+                .global_args('-nostats')
+                .global_args('-loglevel', 'error')
+                .overwrite_output()
+                .run_async(pipe_stdin=True)
         )
 
-        if audio_file.exists():
-            os.system(
-                'ffmpeg -y -i "'
-                + str(colorized_path)
-                + '" -i "'
-                + str(audio_file)
-                + '" -shortest -c:v copy -c:a aac -b:a 256k "'
-                + str(result_path)
-                + '"'
-                + ' -hide_banner'
-                + ' -nostats'
-                + ' -loglevel error'
+        # Started only once the encoder is up, so a failed encoder launch can't leave it orphaned.
+        decoder = None
+        frame_count = 0
+        self._reset_chroma_reuse()
+        try:
+            decoder = (
+                ffmpeg
+                    .input(str(source_path))
+                    .output('pipe:', format='rawvideo', pix_fmt='rgb24')
+                    .global_args('-hide_banner')
+                    .global_args('-nostats')
+                    .global_args('-loglevel', 'error')
+                    .run_async(pipe_stdout=True)
             )
+            finished = False
+            while not finished:
+                frames = []
+                while len(frames) < batch_size:
+                    in_bytes = decoder.stdout.read(frame_bytes)
+                    if len(in_bytes) < frame_bytes:
+                        finished = True
+                        break
+                    frames.append(np.frombuffer(in_bytes, np.uint8).reshape(height, width, 3))
+
+                if not frames:
+                    break
+
+                color_frames = self.vis.get_transformed_arrays(
+                    frames, render_factor=render_factor, post_process=post_process, watermarked=watermarked
+                )
+                for color_frame in color_frames:
+                    encoder.stdin.write(np.ascontiguousarray(color_frame, dtype=np.uint8).tobytes())
+                frame_count += len(frames)
+        except Exception as e:
+            logging.error('Error while streaming frames through the colorizer.  Details: {0}'.format(e), exc_info=True)
+            if decoder is not None:
+                decoder.kill()
+            encoder.kill()
+            raise e
+        finally:
+            if decoder is not None:
+                decoder.stdout.close()
+            if not encoder.stdin.closed:
+                encoder.stdin.close()
+
+        for name, process in (('decoder', decoder), ('encoder', encoder)):
+            returncode = process.wait()
+            if returncode != 0:
+                raise Exception(
+                    'ffmpeg {0} exited with code {1} while streaming {2}'.format(name, returncode, source_path)
+                )
+
+        logging.info('Colorized {0} frames from {1}'.format(frame_count, source_path))
+        self._report_chroma_reuse(source_path)
         logging.info('Video created here: ' + str(result_path))
         return result_path
 
@@ -377,62 +847,218 @@ class VideoColorizer:
         render_factor: int = None,
         post_process: bool = True,
         watermarked: bool = True,
+        streaming: bool = False,
+        resume: bool = True,
 
     ) -> Path:
         source_path = self.source_folder / file_name
         self._download_video_from_url(source_url, source_path)
         return self._colorize_from_path(
-            source_path, render_factor=render_factor, post_process=post_process,watermarked=watermarked
+            source_path, render_factor=render_factor, post_process=post_process,watermarked=watermarked,
+            streaming=streaming, resume=resume,
         )
 
     def colorize_from_file_name(
         self, file_name: str, render_factor: int = None,  watermarked: bool = True, post_process: bool = True,
+        streaming: bool = False, resume: bool = True,
     ) -> Path:
         source_path = self.source_folder / file_name
         return self._colorize_from_path(
-            source_path, render_factor=render_factor,  post_process=post_process,watermarked=watermarked
+            source_path, render_factor=render_factor,  post_process=post_process,watermarked=watermarked,
+            streaming=streaming, resume=resume,
         )
 
     def _colorize_from_path(
-        self, source_path: Path, render_factor: int = None,  watermarked: bool = True, post_process: bool = True
+        self, source_path: Path, render_factor: int = None,  watermarked: bool = True, post_process: bool = True,
+        streaming: bool = False, resume: bool = True,
     ) -> Path:
         if not source_path.exists():
             raise Exception(
                 'Video at path specfied, ' + str(source_path) + ' could not be found.'
             )
-        self._extract_raw_frames(source_path)
-        self._colorize_raw_frames(
-            source_path, render_factor=render_factor,post_process=post_process,watermarked=watermarked
-        )
-        return self._build_video(source_path)
+        if streaming and self.shards is not None:
+            logging.warning('Streaming is not supported with sharded workers; colorizing via frame files instead.')
+        elif streaming:
+            return self._colorize_streaming(
+                source_path, render_factor=render_factor, post_process=post_process, watermarked=watermarked
+            )
+        manifest = self._get_manifest(source_path) if resume else None
+        with stage('extract_frames'):
+            self._extract_raw_frames(source_path, manifest=manifest)
+        with stage('colorize_frames'):
+            self._colorize_raw_frames(
+                source_path, render_factor=render_factor,post_process=post_process,watermarked=watermarked,
+                manifest=manifest,
+            )
+        with stage('build_video'):
+            return self._build_video(source_path)
+
+
+def get_video_colorizer(
+    render_factor: int = 21, dedup_threshold: float = None, keyframe_interval: int = None
+) -> VideoColorizer:
+    return get_stable_video_colorizer(
+        render_factor=render_factor, dedup_threshold=dedup_threshold, keyframe_interval=keyframe_interval
+    )
+
+
+def get_cpu_colorizer_filter(
+    learn: Learner,
+    render_factor: int,
+    calibration_folder: Path = None,
+    channels_last: bool = True,
+    max_calibration_images: int = 16,
+) -> ColorizerFilter:
+    """`ColorizerFilter` tuned for CPU-only nodes: lean inference, folded norms, channels_last and,
+    when `calibration_folder` is given, int8 convs calibrated on the images in it.  The chroma
+    deviation of the int8 model against fp32 on those images is logged and kept in `color_deviation`."""
+    learn.model = learn.model.cpu()
+    filtr = ColorizerFilter(learn=learn, lean_inference=True)
+    optimize_for_inference(learn.model)
+
+    if calibration_folder is not None:
+        paths = get_image_files(Path(calibration_folder))[:max_calibration_images]
+        images = [PIL.Image.open(path).convert('RGB') for path in paths]
+        reference_learn = copy.copy(learn)
+        reference_learn.model = copy.deepcopy(learn.model)
+        reference = ColorizerFilter(learn=reference_learn, lean_inference=True)
+
+        sz = render_factor * filtr.render_base
+        batches = (filtr._prepare_batch([filtr._get_model_ready_image(image, sz)])[0] for image in images)
+        quantize_convs(learn.model, batches)
 
+    if channels_last:
+        learn.model.to(memory_format=torch.channels_last)
+        filtr.channels_last = True
 
-def get_video_colorizer(render_factor: int = 21) -> VideoColorizer:
-    return get_stable_video_colorizer(render_factor=render_factor)
+    if calibration_folder is not None:
+        filtr.color_deviation = check_color_deviation(reference, filtr, images, render_factor)
+        logging.info('int8 vs fp32 color deviation: ' + str(filtr.color_deviation))
+
+    return filtr
+
+
+def _get_colorizer_filter(
+    learn: Learner,
+    render_factor: int,
+    cpu_mode: bool = False,
+    calibration_folder: Path = None,
+    lean_inference: bool = False,
+) -> ColorizerFilter:
+    # CPU mode always runs lean.
+    if cpu_mode:
+        return get_cpu_colorizer_filter(learn, render_factor, calibration_folder=calibration_folder)
+    return ColorizerFilter(learn=learn, lean_inference=lean_inference)
+
+
+def _get_video_filter(
+    learn: Learner,
+    render_factor: int,
+    dedup_threshold: float = None,
+    keyframe_interval: int = None,
+    drift_threshold: float = 6.0,
+    cpu_mode: bool = False,
+    calibration_folder: Path = None,
+    lean_inference: bool = False,
+) -> MasterFilter:
+    filtr = _get_colorizer_filter(
+        learn, render_factor, cpu_mode=cpu_mode, calibration_folder=calibration_folder,
+        lean_inference=lean_inference,
+    )
+    if keyframe_interval is not None:
+        filtr = FlowPropagationFilter(filtr, keyframe_interval=keyframe_interval, drift_threshold=drift_threshold)
+    elif dedup_threshold is not None:
+        filtr = ChromaReuseFilter(filtr, threshold=dedup_threshold)
+    return MasterFilter([filtr], render_factor=render_factor)
 
 
 def get_artistic_video_colorizer(
     root_folder: Path = Path('./'),
     weights_name: str = 'ColorizeArtistic_gen',
     results_dir='result_images',
-    render_factor: int = 35
+    render_factor: int = 35,
+    dedup_threshold: float = None,
+    keyframe_interval: int = None,
+    drift_threshold: float = 6.0,
+    cpu_mode: bool = False,
+    calibration_folder: Path = None,
+    fast: bool = False,
+    mmap_weights: bool = False,
+    lean_inference: bool = False,
 ) -> VideoColorizer:
-    learn = gen_inference_deep(root_folder=root_folder, weights_name=weights_name)
-    filtr = MasterFilter([ColorizerFilter(learn=learn)], render_factor=render_factor)
+    learn = gen_inference_deep(
+        root_folder=root_folder, weights_name=weights_name, fast=fast, mmap_weights=mmap_weights
+    )
+    filtr = _get_video_filter(
+        learn,
+        render_factor,
+        dedup_threshold=dedup_threshold,
+        keyframe_interval=keyframe_interval,
+        drift_threshold=drift_threshold,
+        cpu_mode=cpu_mode,
+        calibration_folder=calibration_folder,
+        lean_inference=lean_inference,
+    )
     vis = ModelImageVisualizer(filtr, results_dir=results_dir)
-    return VideoColorizer(vis)
+    return VideoColorizer(vis, weights_name=weights_name)
 
 
 def get_stable_video_colorizer(
     root_folder: Path = Path('./'),
     weights_name: str = 'ColorizeVideo_gen',
     results_dir='result_images',
-    render_factor: int = 21
+    render_factor: int = 21,
+    dedup_threshold: float = None,
+    keyframe_interval: int = None,
+    drift_threshold: float = 6.0,
+    cpu_mode: bool = False,
+    calibration_folder: Path = None,
+    fast: bool = False,
+    mmap_weights: bool = False,
+    lean_inference: bool = False,
 ) -> VideoColorizer:
-    learn = gen_inference_wide(root_folder=root_folder, weights_name=weights_name)
-    filtr = MasterFilter([ColorizerFilter(learn=learn)], render_factor=render_factor)
+    learn = gen_inference_wide(
+        root_folder=root_folder, weights_name=weights_name, fast=fast, mmap_weights=mmap_weights
+    )
+    filtr = _get_video_filter(
+        learn,
+        render_factor,
+        dedup_threshold=dedup_threshold,
+        keyframe_interval=keyframe_interval,
+        drift_threshold=drift_threshold,
+        cpu_mode=cpu_mode,
+        calibration_folder=calibration_folder,
+        lean_inference=lean_inference,
+    )
     vis = ModelImageVisualizer(filtr, results_dir=results_dir)
-    return VideoColorizer(vis)
+    return VideoColorizer(vis, weights_name=weights_name)
+
+
+def get_sharded_video_colorizer(
+    workers: Union[int, Sequence[DeviceId]] = 2,
+    artistic: bool = False,
+    render_factor: int = None,
+    fast: bool = True,
+    mmap_weights: bool = False,
+    **kwargs,
+) -> VideoColorizer:
+    """`VideoColorizer` that spreads frames over worker processes, each loading its own generator.
+    `workers` is either a number of CPU workers (each pinned to its own share of the cores) or a
+    list of devices, e.g. `[DeviceId.GPU0, DeviceId.GPU1]`.  Workers build their generators with
+    `fast` construction by default; with `mmap_weights` they all map the same `models/*.flat` file
+    (see `flat_weights`), so the weights are held in memory once per host.  Other arguments go to
+    `get_artistic_video_colorizer`/`get_stable_video_colorizer` in each worker."""
+    devices = [DeviceId.CPU] * workers if isinstance(workers, int) else list(workers)
+    if artistic:
+        factory, weights_name, default_render_factor = 'get_artistic_video_colorizer', 'ColorizeArtistic_gen', 35
+    else:
+        factory, weights_name, default_render_factor = 'get_stable_video_colorizer', 'ColorizeVideo_gen', 21
+    kwargs.setdefault('weights_name', weights_name)
+    kwargs['render_factor'] = ifnone(render_factor, default_render_factor)
+    kwargs['fast'] = fast
+    kwargs['mmap_weights'] = mmap_weights
+    shards = ShardedFrameColorizer(devices, factory=factory, **kwargs)
+    return VideoColorizer(None, weights_name=kwargs['weights_name'], shards=shards)
 
 
 def get_image_colorizer(
@@ -448,11 +1074,23 @@ def get_stable_image_colorizer(
     root_folder: Path = Path('./'),
     weights_name: str = 'ColorizeStable_gen',
     results_dir='result_images',
-    render_factor: int = 35
+    render_factor: int = 35,
+    cpu_mode: bool = False,
+    calibration_folder: Path = None,
+    cache: ResultCache = None,
+    fast: bool = False,
+    mmap_weights: bool = False,
+    lean_inference: bool = False,
 ) -> ModelImageVisualizer:
-    learn = gen_inference_wide(root_folder=root_folder, weights_name=weights_name)
-    filtr = MasterFilter([ColorizerFilter(learn=learn)], render_factor=render_factor)
-    vis = ModelImageVisualizer(filtr, results_dir=results_dir)
+    learn = gen_inference_wide(
+        root_folder=root_folder, weights_name=weights_name, fast=fast, mmap_weights=mmap_weights
+    )
+    filtr = _get_colorizer_filter(
+        learn, render_factor, cpu_mode=cpu_mode, calibration_folder=calibration_folder,
+        lean_inference=lean_inference,
+    )
+    filtr = MasterFilter([filtr], render_factor=render_factor)
+    vis = ModelImageVisualizer(filtr, results_dir=results_dir, cache=cache, weights_name=weights_name)
     return vis
 
 
@@ -460,23 +1098,35 @@ def get_artistic_image_colorizer(
     root_folder: Path = Path('./'),
     weights_name: str = 'ColorizeArtistic_gen',
     results_dir='result_images',
-    render_factor: int = 35
+    render_factor: int = 35,
+    cpu_mode: bool = False,
+    calibration_folder: Path = None,
+    cache: ResultCache = None,
+    fast: bool = False,
+    mmap_weights: bool = False,
+    lean_inference: bool = False,
 ) -> ModelImageVisualizer:
-    learn = gen_inference_deep(root_folder=root_folder, weights_name=weights_name)
-    filtr = MasterFilter([ColorizerFilter(learn=learn)], render_factor=render_factor)
-    vis = ModelImageVisualizer(filtr, results_dir=results_dir)
+    learn = gen_inference_deep(
+        root_folder=root_folder, weights_name=weights_name, fast=fast, mmap_weights=mmap_weights
+    )
+    filtr = _get_colorizer_filter(
+        learn, render_factor, cpu_mode=cpu_mode, calibration_folder=calibration_folder,
+        lean_inference=lean_inference,
+    )
+    filtr = MasterFilter([filtr], render_factor=render_factor)
+    vis = ModelImageVisualizer(filtr, results_dir=results_dir, cache=cache, weights_name=weights_name)
     return vis
 
 
 def show_image_in_notebook(image_path: Path):
-    ipythondisplay.display(ipythonimage(str(image_path)))
+    ipythondisplay.display(ipythondisplay.Image(str(image_path)))
 
 
 def show_video_in_notebook(video_path: Path):
     video = io.open(video_path, 'r+b').read()
     encoded = base64.b64encode(video)
     ipythondisplay.display(
-        HTML(
+        ipythondisplay.HTML(
             data='''<video alt="test" autoplay 
                 loop controls style="height: 400px;">
                 <source src="data:video/mp4;base64,{0}" type="video/mp4" />
@@ -0,0 +1,73 @@
+import threading
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+from PIL import Image
+
+
+# adapted from https://www.pyimagesearch.com/2016/04/25/watermarking-images-with-opencv-and-python/
+class WatermarkCompositor:
+    """Blends the watermark into the bottom left corner of images.
+
+    The watermark is decoded once and kept pre-scaled per output height, and only the
+    watermark's region of the image is touched, so repeated frames of the same size cost
+    a single small `addWeighted`.
+    """
+
+    def __init__(
+        self,
+        path: str = './resource_images/watermark.png',
+        pct: float = 0.05,
+        margin: int = 10,
+        max_cached: int = 16,
+    ):
+        self.path = path
+        self.pct = pct
+        self.margin = margin
+        self.max_cached = max_cached
+        self._lock = threading.Lock()
+        self._full = None
+        self._scaled = OrderedDict()
+
+    def _full_watermark(self) -> np.ndarray:
+        if self._full is None:
+            full = cv2.imread(self.path, cv2.IMREAD_UNCHANGED)
+            if full is None:
+                raise IOError('Could not read watermark at ' + str(self.path))
+            # Only the color channels ever made it into the output, so drop alpha and go to RGB up front.
+            self._full = cv2.cvtColor(full[:, :, :3], cv2.COLOR_BGR2RGB)
+        return self._full
+
+    def _get_scaled(self, h: int) -> np.ndarray:
+        with self._lock:
+            if h in self._scaled:
+                self._scaled.move_to_end(h)
+                return self._scaled[h]
+            full = self._full_watermark()
+            (fwH, fwW) = full.shape[:2]
+            wH = int(self.pct * h)
+            wW = int((self.pct * h / fwH) * fwW)
+            # NB: (wH, wW) is passed as cv2's (width, height), as the original watermarking code always did.
+            scaled = cv2.resize(full, (wH, wW), interpolation=cv2.INTER_AREA)
+            self._scaled[h] = scaled
+            if len(self._scaled) > self.max_cached:
+                self._scaled.popitem(last=False)
+            return scaled
+
+    def apply_array(self, image: np.ndarray, in_place: bool = False) -> np.ndarray:
+        "Watermark an RGB uint8 HxWx3 array; with `in_place`, writes into `image` when it's writeable."
+        (h, w) = image.shape[:2]
+        watermark = self._get_scaled(h)
+        (wH, wW) = watermark.shape[:2]
+        top, left = h - wH - self.margin, self.margin
+        if top < 0 or left + wW > w:
+            return image
+        if not in_place or not image.flags.writeable:
+            image = image.copy()
+        roi = image[top : top + wH, left : left + wW]
+        roi[...] = cv2.addWeighted(watermark, 0.5, roi, 1.0, 0)
+        return image
+
+    def apply(self, pil_image: Image.Image) -> Image.Image:
+        return Image.fromarray(self.apply_array(np.array(pil_image), in_place=True))